@@ -0,0 +1,197 @@
+"""
+Push device state changes and command completions to the open house_app
+pages as Server-Sent Events.
+
+All events go through one in-process bus.  A single publisher thread waits
+for the device state to change and builds and encodes each new snapshot once,
+however many pages are listening, and each page's stream only waits for the
+messages the bus hands it.
+"""
+import threading
+import collections
+import time
+
+import webapi
+import irsignal
+import wemo
+from .state import device_state, waiting_request_slots
+from . import macros
+
+# A comment is sent this often on otherwise quiet streams, so connections that
+# were dropped are noticed and proxies don't time the stream out.
+KEEPALIVE_INTERVAL_IN_S = 20
+
+# Streams are ended after this long and the browser reconnects, so that a
+# stream's thread is eventually returned even if its disconnect isn't noticed.
+MAX_STREAM_TIME_IN_S = 600
+
+# If a subscriber falls this many messages behind, its oldest messages are
+# dropped.  The next device_state message replaces the dropped ones anyway.
+MAX_QUEUED_MESSAGES = 100
+
+class EventBus(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        self.last_device_state_message = None
+
+    def subscribe(self):
+        """Return a new Subscription, or None if all the waiting request
+        slots (see state.MAX_WAITING_REQUESTS) are in use.
+        """
+        with self.lock:
+            # Streams that were never started, or whose threads are gone,
+            # stop reading without unsubscribing, so drop them here.
+            for subscription in list(self.subscribers):
+                if subscription.is_abandoned():
+                    self._remove_subscriber(subscription)
+
+            if not waiting_request_slots.acquire(False):
+                return None
+
+        try:
+            subscription = None
+            while subscription is None:
+                version = message = None
+                if not self._is_publishing():
+                    # Building a snapshot may ask the devices for their state,
+                    # so it isn't done while holding the lock, which
+                    # publishing needs.
+                    version, message = self._device_state_message()
+                subscription = self._add_subscriber(version, message)
+            return subscription
+        except:
+            waiting_request_slots.release()
+            raise
+
+    def _add_subscriber(self, version, message):
+        """Add a Subscription and return it, starting the publisher thread
+        with the given snapshot message if it isn't running.  If it isn't
+        running and no message was given, return None.
+        """
+        with self.lock:
+            if not self._is_publishing():
+                if message is None:
+                    return None
+                self.last_device_state_message = message
+                self.thread = threading.Thread(
+                    target=self._run_publisher_thread, args=(version,))
+                self.thread.daemon = True
+                self.thread.start()
+
+            # The subscriber gets the latest snapshot before any newer ones.
+            subscription = Subscription(self)
+            subscription.put(self.last_device_state_message)
+            self.subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self._remove_subscriber(subscription)
+
+    def _remove_subscriber(self, subscription):
+        if subscription in self.subscribers:
+            self.subscribers.discard(subscription)
+            waiting_request_slots.release()
+
+    def _is_publishing(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def publish(self, event_name, value):
+        """Send an event, whose data is value encoded as JSON, to all
+        subscribers.
+        """
+        self._publish_message(
+            _event_message(event_name, webapi.encode_json(value)))
+
+    def _publish_message(self, message):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def _run_publisher_thread(self, version):
+        while True:
+            # The thread exits once the last subscriber leaves, and subscribe
+            # starts a new one when a subscriber arrives.
+            with self.lock:
+                if len(self.subscribers) == 0:
+                    self.thread = None
+                    return
+
+            if device_state.wait_for_version_change(
+                    version, KEEPALIVE_INTERVAL_IN_S) == version:
+                continue
+
+            version, message = self._device_state_message()
+            with self.lock:
+                self.last_device_state_message = message
+            self._publish_message(message)
+
+    def _device_state_message(self):
+        version, snapshot_json = device_state.snapshot_json()
+        return version, _event_message("device_state", snapshot_json, version)
+
+class Subscription(object):
+    """The queue of messages waiting to be sent on one page's stream."""
+    def __init__(self, event_bus):
+        self.event_bus = event_bus
+        self.condition = threading.Condition()
+        self.messages = collections.deque(maxlen=MAX_QUEUED_MESSAGES)
+        self.last_read_time = time.time()
+
+    def put(self, message):
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify()
+
+    def is_abandoned(self):
+        return time.time() - self.last_read_time > KEEPALIVE_INTERVAL_IN_S * 3
+
+    def iter_messages(self):
+        """Generate the stream's messages, plus keepalive comments, until
+        MAX_STREAM_TIME_IN_S passes or the generator is closed.
+        """
+        end_time = time.time() + MAX_STREAM_TIME_IN_S
+        try:
+            # Tell the browser how long to wait before reconnecting.
+            yield "retry: 2000\n\n"
+            while time.time() < end_time:
+                self.last_read_time = time.time()
+                with self.condition:
+                    if len(self.messages) == 0:
+                        self.condition.wait(KEEPALIVE_INTERVAL_IN_S)
+                    messages = list(self.messages)
+                    self.messages.clear()
+
+                if len(messages) == 0:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "".join(messages)
+        finally:
+            self.event_bus.unsubscribe(self)
+
+def _event_message(event_name, data_json, event_id=None):
+    lines = ["event: %s" % event_name]
+    if event_id is not None:
+        lines.append("id: %s" % event_id)
+    lines.append("data: %s" % data_json)
+    return "\n".join(lines) + "\n\n"
+
+event_bus = EventBus()
+
+def _on_button_pressed(device_name, button_name, **kwargs):
+    event_bus.publish(
+        "button_pressed", {"device": device_name, "button": button_name})
+
+def _on_switch_state_changed(switch_name, is_on, **kwargs):
+    event_bus.publish(
+        "switch_state_changed", {"switch_name": switch_name, "is_on": is_on})
+
+def _on_macro_finished(macro_run, **kwargs):
+    event_bus.publish("macro_finished", macro_run.to_json())
+
+irsignal.button_pressed.connect(_on_button_pressed)
+wemo.switch_state_changed.connect(_on_switch_state_changed)
+macros.macro_finished.connect(_on_macro_finished)
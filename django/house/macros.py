@@ -0,0 +1,141 @@
+"""
+Run macros: sequences of IR, light, and switch actions with delays between
+them.  The steps run on the timer-driven scheduler, so no thread sleeps while
+a macro waits between steps.
+
+Each step's delay is measured from when the previous step's action finished,
+which for IR signals is when the device finished sending, and not from when
+the step was dispatched.  Some devices ignore signals that arrive too soon
+after the previous one, so neither queueing nor sending time eats into it.
+"""
+import time
+import collections
+
+from django.dispatch import Signal
+
+import irsignal
+import huelights
+import wemo
+from .models import Macro
+from .scheduler import scheduler
+from housesite.clock import monotonic_time
+
+def _press_remote(device, button, repeat=1):
+    return irsignal.queue_button_press(device, button, repeat)
+
+# These map the action names used in macro steps to the functions that
+# perform them.
+ACTIONS = {
+    "press_remote": _press_remote,
+    "set_light_scene": huelights.set_scene,
+    "turn_on_switch": wemo.turn_on_switch,
+    "turn_off_switch": wemo.turn_off_switch,
+}
+
+# This signal is sent when a macro run finishes, with the MacroRun.
+macro_finished = Signal(providing_args=["macro_run"])
+
+# The most recent macro runs, oldest first, so their timings can be inspected.
+_recent_macro_runs = collections.deque(maxlen=20)
+
+def run_macro(macro_name):
+    """Start running the stored macro with the given name and return its
+    MacroRun.
+    """
+    return run_steps(macro_name, Macro.objects.get(name=macro_name).steps())
+
+def run_steps(name, steps):
+    """Start running the given macro steps (see house.models.Macro for their
+    format) and return the MacroRun.
+    """
+    for step in steps:
+        if step["action"] not in ACTIONS:
+            raise RuntimeError("Invalid macro action: %s" % step["action"])
+
+    # Compile the IR signals now, so the steps don't need the database.
+    for step in steps:
+        if step["action"] == "press_remote":
+            kwargs = step.get("kwargs", {})
+            irsignal.get_iguana_payload_for_button(
+                kwargs["device"], kwargs["button"], kwargs.get("repeat", 1))
+
+    macro_run = MacroRun(name, steps)
+    _recent_macro_runs.append(macro_run)
+    macro_run.start()
+    return macro_run
+
+def recent_macro_runs():
+    return [macro_run.to_json() for macro_run in _recent_macro_runs]
+
+class MacroRun(object):
+    """Run the steps of a macro one after the other.  For each step, record
+    when it was planned relative to the start of the run, how late the step
+    started, the jitter (how late its action actually took effect, which for
+    IR signals includes waiting in the transmit queue), and how long the
+    action took.  If a step fails, the remaining steps are not run.
+    """
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+        self.start_time = None
+        self.monotonic_start_time = None
+        self.step_timings = []
+        self.is_finished = False
+
+    def start(self):
+        self.start_time = time.time()
+        self.monotonic_start_time = monotonic_time()
+        scheduler.call_at(self.monotonic_start_time,
+            self._run_step, 0, self.monotonic_start_time)
+
+    def _run_step(self, step_index, planned_time):
+        step = self.steps[step_index]
+        start_time = monotonic_time()
+        error = None
+        try:
+            result = ACTIONS[step["action"]](**step.get("kwargs", {}))
+        except Exception as e:
+            result = None
+            error = str(e)
+        end_time = monotonic_time()
+
+        # IR presses are sent by the transmit thread, which records when the
+        # device actually sent the signal.
+        action_start_time, action_end_time = start_time, end_time
+        if (isinstance(result, irsignal.models.TransmitRequest) and
+                result.send_end_time is not None):
+            action_start_time = result.send_start_time
+            action_end_time = result.send_end_time
+
+        def to_ms(duration_in_s):
+            return int(round(duration_in_s * 1000))
+
+        self.step_timings.append({
+            "action": step["action"],
+            "kwargs": step.get("kwargs", {}),
+            "planned_offset_in_ms": to_ms(
+                planned_time - self.monotonic_start_time),
+            "lateness_in_ms": to_ms(start_time - planned_time),
+            "jitter_in_ms": to_ms(action_start_time - planned_time),
+            "transmit_duration_in_ms": to_ms(
+                action_end_time - action_start_time),
+            "duration_in_ms": to_ms(end_time - start_time),
+            "error": error,
+        })
+
+        if error is not None or step_index + 1 == len(self.steps):
+            self.is_finished = True
+            macro_finished.send(sender=None, macro_run=self)
+            return
+
+        next_planned_time = action_end_time + step.get("delay_in_s", 0)
+        scheduler.call_at(next_planned_time,
+            self._run_step, step_index + 1, next_planned_time)
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "start_time": self.start_time,
+            "is_finished": self.is_finished,
+            "step_timings": self.step_timings,
+        }
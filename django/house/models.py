@@ -1,3 +1,25 @@
+import json
+
 from django.db import models
 
-# Create your models here.
+class Macro(models.Model):
+    """A named sequence of steps, like "movie mode".
+
+    The steps are stored as a JSON list of dictionaries, each with the name of
+    an action (see house.macros.ACTIONS), the keyword arguments to pass to it,
+    and the number of seconds to wait after it before running the next step:
+        [{"action": "press_remote",
+          "kwargs": {"device": "elitescreens", "button": "down"},
+          "delay_in_s": 55}, ...]
+    """
+    name = models.CharField(max_length=60, unique=True)
+    steps_json = models.TextField()
+
+    def __unicode__(self):
+        return self.name
+
+    def steps(self):
+        return json.loads(self.steps_json)
+
+    class Meta:
+        app_label = "house"
@@ -0,0 +1,89 @@
+"""
+A timer-driven scheduler that runs functions at given times.  Nothing ties up
+a thread while waiting: a single timer thread hands functions that are due to
+a small thread pool.
+
+Times are on the monotonic clock from housesite.clock, so setting the system
+clock doesn't move functions that are already scheduled.
+"""
+import time
+import heapq
+import itertools
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from django import db
+
+from housesite.clock import monotonic_time
+
+# Functions are handed to the pool this long before they are due, and the pool
+# thread sleeps until the exact time.  Python 2's Condition.wait polls in steps
+# of up to 50ms, so the timer thread may take that long to notice a newly
+# scheduled function, while time.sleep is precise.
+HANDOFF_LEAD_TIME_IN_S = 0.1
+
+class Scheduler(object):
+    def __init__(self, num_threads=4):
+        self.num_threads = num_threads
+        self.condition = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.thread = None
+        self.pool = None
+
+    def call_later(self, delay_in_s, function, *args, **kwargs):
+        self.call_at(monotonic_time() + delay_in_s, function, *args, **kwargs)
+
+    def call_at(self, due_time, function, *args, **kwargs):
+        with self.condition:
+            self._start()
+
+            if due_time - monotonic_time() <= HANDOFF_LEAD_TIME_IN_S:
+                self.pool.apply_async(
+                    _run_function, (due_time, function, args, kwargs))
+                return
+
+            # The counter breaks ties between functions due at the same time,
+            # so they run in the order they were scheduled.
+            heapq.heappush(self.queue,
+                (due_time, next(self.counter), function, args, kwargs))
+            self.condition.notify()
+
+    def _start(self):
+        if self.thread is not None:
+            return
+
+        self.pool = ThreadPool(self.num_threads)
+        self.thread = threading.Thread(target=self._run, name="house-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while (len(self.queue) == 0 or self.queue[0][0] -
+                        HANDOFF_LEAD_TIME_IN_S > monotonic_time()):
+                    self.condition.wait(
+                        self.queue[0][0] - HANDOFF_LEAD_TIME_IN_S -
+                            monotonic_time()
+                        if len(self.queue) != 0 else None)
+                due_time, _, function, args, kwargs = heapq.heappop(self.queue)
+
+            self.pool.apply_async(
+                _run_function, (due_time, function, args, kwargs))
+
+def _run_function(due_time, function, args, kwargs):
+    try:
+        remaining_time_in_s = due_time - monotonic_time()
+        if remaining_time_in_s > 0:
+            time.sleep(remaining_time_in_s)
+        function(*args, **kwargs)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # The pool threads live forever, so don't leave database connections
+        # open in them.
+        db.connection.close()
+
+scheduler = Scheduler()
@@ -0,0 +1,114 @@
+"""
+Keep a versioned snapshot of the state of all devices: the last button pressed
+for each IR device, the Hue light states, and the WeMo switch states.  The
+version goes up whenever any of them changes, so clients can skip fetching a
+snapshot they already have or wait for the next change.
+
+Like the state the snapshot comes from, this is per-process, and the web
+server runs in a single daemon process.
+"""
+import threading
+import time
+import traceback
+
+import webapi
+import irsignal
+import huelights
+import wemo
+
+# Long polls are cut off after this long so they don't outlive proxies' and
+# browsers' request timeouts.
+MAX_WAIT_TIME_IN_S = 55
+
+# Each long poll and event stream (see events.py) ties up one of the web
+# server's 15 threads (see INSTALL.md) while it waits, so together only this
+# many may wait at once, leaving the other threads for ordinary requests.
+# Other long polls return the current snapshot right away, and other pages
+# fall back from streaming to long-polling.
+MAX_WAITING_REQUESTS = 6
+
+# A slot must be acquired, without blocking, before a request waits.
+waiting_request_slots = threading.BoundedSemaphore(MAX_WAITING_REQUESTS)
+
+class DeviceState(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 1
+
+        # The snapshot and its JSON are built at most once per version, no
+        # matter how many clients ask for it.
+        self.cached_version = None
+        self.cached_snapshot_json = None
+
+    def changed(self, **kwargs):
+        """Note that some device's state changed.  This is connected to the
+        device apps' change signals, whose arguments it ignores.
+        """
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def snapshot_json(self):
+        """Return a (version, JSON string) pair for the current snapshot.  A
+        part of the snapshot whose devices can't be reached is null.
+        """
+        with self.condition:
+            version = self.version
+            if self.cached_version == version:
+                return version, self.cached_snapshot_json
+
+        snapshot = {"version": version}
+        is_complete = True
+        for name, get_states in (
+                ("ir", irsignal.get_last_pressed_buttons),
+                ("lights", huelights.get_light_states),
+                ("switches", wemo.get_switch_states)):
+            try:
+                snapshot[name] = get_states()
+            except Exception:
+                traceback.print_exc()
+                snapshot[name] = None
+                is_complete = False
+        snapshot_json = webapi.encode_json(snapshot)
+
+        with self.condition:
+            # Only cache the snapshot if nothing changed while it was built,
+            # and retry the parts that failed next time.
+            if self.version == version and is_complete:
+                self.cached_version = version
+                self.cached_snapshot_json = snapshot_json
+        return version, snapshot_json
+
+    def wait_for_change(self, since_version, timeout_in_s):
+        """Wait until the version differs from since_version or the timeout
+        expires, and return a (version, JSON string) pair for the snapshot
+        at that point.
+        """
+        timeout_in_s = min(max(float(timeout_in_s), 0), MAX_WAIT_TIME_IN_S)
+        if waiting_request_slots.acquire(False):
+            try:
+                self.wait_for_version_change(since_version, timeout_in_s)
+            finally:
+                waiting_request_slots.release()
+
+        return self.snapshot_json()
+
+    def wait_for_version_change(self, since_version, timeout_in_s):
+        """Wait until the version differs from since_version or the timeout
+        expires, and return the version.  Unlike wait_for_change, this
+        doesn't use up a waiting request slot.
+        """
+        end_time = time.time() + timeout_in_s
+        with self.condition:
+            while self.version == since_version:
+                remaining_time_in_s = end_time - time.time()
+                if remaining_time_in_s <= 0:
+                    break
+                self.condition.wait(remaining_time_in_s)
+            return self.version
+
+device_state = DeviceState()
+
+irsignal.button_pressed.connect(device_state.changed)
+huelights.light_states_changed.connect(device_state.changed)
+wemo.switch_state_changed.connect(device_state.changed)
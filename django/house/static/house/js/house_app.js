@@ -14,6 +14,16 @@ angular.module('house_app', [])
         );
     }
 
+    $scope.ajax_batch_call = function(calls, callback)
+    {
+        ajax_batch_call(
+            $attrs.apiurl, calls,
+            scope_apply_callback($scope, function(api_results) {
+                run_possible_callback(callback, api_results);
+            })
+        );
+    }
+
     $scope.press_remote_button = function (device, button)
     {
         $scope.ajax_call(
@@ -28,27 +38,42 @@ angular.module('house_app', [])
                 devices_and_buttons_and_timeouts});
     }
 
+    $scope.run_macro = function (macro_name)
+    {
+        $scope.ajax_call("run_macro", {"macro_name": macro_name});
+    }
+
     $scope.on_remote_button_down = function (device, button)
     {
-        $scope.pressed_device_and_button = [device, button];
-        function send_signal()
+        // The server repeats the button's signal for as long as it is held.
+        // Keep telling it the button is still held, because it releases the
+        // button by itself if it stops hearing from us.  The calls can arrive
+        // in any order, so they all carry an id for this press, and the
+        // server ignores holds for an id that it already saw released.
+        $scope.on_remote_button_up();
+        var hold_id = Date.now() + "-" + Math.random().toString(36).slice(2);
+        $scope.pressed_device_and_button = [device, button, hold_id];
+        function hold()
         {
-            $scope.ajax_call(
-                "press_remote",
-                {"device": device, "button": button},
-                function () {
-                    if ($scope.pressed_device_and_button[0] == device &&
-                            $scope.pressed_device_and_button[1] == button)
-                        send_signal();
-                }
-            );
+            $scope.ajax_call("hold_remote_button",
+                {"device": device, "button": button, "hold_id": hold_id});
         }
-        send_signal();
+        hold();
+        $scope.hold_interval = setInterval(hold, 300);
     }
 
     $scope.on_remote_button_up = function ()
     {
-        $scope.pressed_device_and_button = [null, null];
+        var device = $scope.pressed_device_and_button[0];
+        var button = $scope.pressed_device_and_button[1];
+        var hold_id = $scope.pressed_device_and_button[2];
+        if (device === null)
+            return;
+
+        clearInterval($scope.hold_interval);
+        $scope.pressed_device_and_button = [null, null, null];
+        $scope.ajax_call("release_remote_button",
+            {"device": device, "button": button, "hold_id": hold_id});
     }
 
     $scope.set_light_scene = function (scene_name)
@@ -66,8 +91,71 @@ angular.module('house_app', [])
         $scope.ajax_call("turn_off_switch", {"switch_name": switch_name});
     }
 
+    $scope.watch_device_state = function ()
+    {
+        // Keep $scope.device_state up to date by long-polling the server for
+        // the next version of it.  The server answers with 304 Not Modified
+        // when nothing changed before the poll timed out.
+        var version = ($scope.device_state === null
+            ? 0 : $scope.device_state.version);
+        $.ajax({
+            type: "POST",
+            url: $attrs.apiurl,
+            data: "json=" + encodeURIComponent(JSON.stringify([
+                "wait_for_device_state", [],
+                {"since_version": version, "timeout_in_s": 50}])),
+            headers: {"If-None-Match": '"' + version + '"'},
+            global: false,
+            success: scope_apply_callback($scope, function (data, status) {
+                // If the server was too busy to wait, it answers right away,
+                // so pause before polling again in that case.
+                if (status == "notmodified")
+                    setTimeout($scope.watch_device_state, 1000);
+                else
+                {
+                    $scope.device_state = data;
+                    $scope.watch_device_state();
+                }
+            }),
+            error: function () {
+                setTimeout($scope.watch_device_state, 5000);
+            }
+        });
+    }
+
+    $scope.listen_for_events = function ()
+    {
+        // Receive device state changes and command completions as
+        // Server-Sent Events.  If the browser doesn't support them, or the
+        // server refuses the stream, long-poll for device state instead.
+        if (typeof EventSource == "undefined")
+        {
+            $scope.watch_device_state();
+            return;
+        }
+
+        var event_source = new EventSource($attrs.eventsurl);
+        event_source.addEventListener("device_state",
+            scope_apply_callback($scope, function (event) {
+                $scope.device_state = JSON.parse(event.data);
+            }));
+        event_source.addEventListener("macro_finished",
+            scope_apply_callback($scope, function (event) {
+                $scope.last_finished_macro_run = JSON.parse(event.data);
+            }));
+        event_source.onerror = function () {
+            // The browser reconnects by itself after dropped connections,
+            // but gives up if the server responded with an error.
+            if (event_source.readyState == EventSource.CLOSED)
+                $scope.watch_device_state();
+        };
+    }
+
     init = function() {
-        $scope.pressed_device_and_button = [null, null];
+        $scope.pressed_device_and_button = [null, null, null];
+        $scope.device_state = null;
+        $scope.last_finished_macro_run = null;
+        $scope.listen_for_events();
     }
 
     init();
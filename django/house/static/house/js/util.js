@@ -66,19 +66,34 @@ function run_possible_callback(callback)
 }
 
 function ajax_call(api_url, function_name, kwargs, callback)
+{
+    // Make an ajax call to the api url, running the given callback when
+    // the server gives a response.
+    ajax_call_with_json(api_url, [function_name, [], kwargs], callback);
+};
+
+function ajax_call_with_json(api_url, json_data, callback)
 {
     if (typeof api_url == "undefined")
         alert("Error: api_url is undefined.  (Perhaps the data-apiurl" +
             " attribute is missing?)");
 
-    // Make an ajax call to the api url, running the given callback when
-    // the server gives a response.
     $.post(
         api_url,
-        "json=" + encodeURIComponent(
-            JSON.stringify([function_name, [], kwargs])),
+        "json=" + encodeURIComponent(JSON.stringify(json_data)),
         callback);
-};
+}
+
+function ajax_batch_call(api_url, calls, callback)
+{
+    // Make one ajax call that runs several API functions on the server.  calls
+    // is a list of [function_name, kwargs] pairs, and the callback receives a
+    // list with a {result, error, status, duration_in_ms} object per call.
+    ajax_call_with_json(
+        api_url,
+        calls.map(function (call) { return [call[0], [], call[1]]; }),
+        callback);
+}
 
 function ajax_call_that_saves($scope, api_url, function_name, kwargs, callback)
 {
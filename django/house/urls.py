@@ -4,5 +4,6 @@ from . import views
 
 urlpatterns = patterns("house.views",
     url(r'^api$', views.api_view, name='api'),
+    url(r'^events$', views.events_view, name='events'),
     url(r'^$', views.index_view, name='index'),
 )
@@ -1,26 +1,80 @@
 from django.template import RequestContext
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
+from django.http import (
+    HttpResponse, HttpResponseNotModified, StreamingHttpResponse)
 
 import webapi
 import irsignal
 import huelights
 import wemo
 from . import tasks
+from . import macros
+from .state import device_state
+from .events import event_bus
 
 class HouseAPI(webapi.API):
     @webapi.api_method
+    @webapi.serialize_calls("ir")
     def press_remote(self, request, device, button):
-        if not irsignal.is_busy():
-            irsignal.press_button(device, button)
+        irsignal.queue_button_press(device, button)
 
-    def press_remote_buttons(devices_and_buttons_and_timeouts):
-        tasks.press_remote_buttons.delay(devices_and_buttons_and_timeouts)
+    @webapi.api_method
+    def hold_remote_button(self, request, device, button, hold_id):
+        """Start holding down a button, or keep holding it.  The client must
+        keep calling this while the button is held, or the server releases
+        it (see irsignal.hold_button).  hold_id is chosen by the client, and
+        is the same for every call for one press of the button.
+        """
+        irsignal.hold_button(device, button, hold_id)
+
+    @webapi.api_method
+    def release_remote_button(self, request, device, button, hold_id):
+        irsignal.release_button(device, button, hold_id)
+
+    @webapi.api_method
+    def list_remote_buttons(self, request):
+        return irsignal.models.ProntoCode.objects.order_by(
+            "device", "button").values("device", "button")
+
+    @webapi.api_method
+    @webapi.serialize_calls("ir")
+    def press_remote_buttons(self, request, devices_and_buttons_and_timeouts):
+        macros.run_steps("press_remote_buttons", [
+            {"action": "press_remote",
+             "kwargs": {"device": device, "button": button},
+             "delay_in_s": timeout_in_s}
+            for device, button, timeout_in_s in tasks.grouper(
+                devices_and_buttons_and_timeouts, 3, 0)])
+
+    @webapi.api_method
+    def run_macro(self, request, macro_name):
+        macros.run_macro(macro_name)
+
+    @webapi.api_method
+    def get_recent_macro_runs(self, request):
+        return macros.recent_macro_runs()
 
     @webapi.api_method
     def set_light_scene(self, request, scene_name):
         huelights.set_scene(scene_name)
 
+    @webapi.api_method
+    def get_light_states(self, request):
+        return huelights.get_light_states()
+
+    @webapi.api_method
+    def set_light_states(self, request, light_states):
+        huelights.set_light_states(light_states)
+
+    @webapi.api_method
+    def set_light_group_states(self, request, group_states):
+        huelights.set_group_states(group_states)
+
+    @webapi.api_method
+    def list_light_scenes(self, request):
+        return huelights.list_scenes()
+
     @webapi.api_method
     def turn_on_switch(self, request, switch_name):
         wemo.turn_on_switch(switch_name)
@@ -29,9 +83,65 @@ class HouseAPI(webapi.API):
     def turn_off_switch(self, request, switch_name):
         wemo.turn_off_switch(switch_name)
 
+    @webapi.api_method
+    def get_switch_states(self, request):
+        return wemo.get_switch_states()
+
+    @webapi.api_method
+    def set_switches(self, request, switch_names, is_on):
+        return wemo.set_switches(switch_names, is_on)
+
+    @webapi.api_method
+    def set_switch_group(self, request, group_name, is_on):
+        return wemo.set_switch_group(group_name, is_on)
+
+    @webapi.api_method
+    def get_device_state(self, request):
+        """Return the snapshot of all device state.  If the client already
+        has the current version, as named by its If-None-Match header, only
+        a 304 response is sent.
+        """
+        version, snapshot_json = device_state.snapshot_json()
+        return _device_state_response(request, version, snapshot_json)
+
+    @webapi.api_method
+    def wait_for_device_state(self, request, since_version, timeout_in_s):
+        """Like get_device_state, but first wait up to timeout_in_s seconds
+        for the version to change from since_version.
+        """
+        version, snapshot_json = device_state.wait_for_change(
+            since_version, timeout_in_s)
+        return _device_state_response(request, version, snapshot_json)
+
+def _device_state_response(request, version, snapshot_json):
+    etag = '"%s"' % version
+    if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(snapshot_json, content_type="application/json")
+        response["Content-Length"] = str(len(snapshot_json))
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"
+    return response
+
 @csrf_exempt
 def api_view(request):
     return HouseAPI().dispatch(request)
 
+def events_view(request):
+    """Stream device state changes and command completions as Server-Sent
+    Events.  If too many streams are already open, respond with 503 so the
+    page falls back to long-polling.
+    """
+    subscription = event_bus.subscribe()
+    if subscription is None:
+        return HttpResponse("Too many event streams are open", status=503)
+
+    response = StreamingHttpResponse(
+        subscription.iter_messages(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 def index_view(request):
     return render(request, "house/index.html", RequestContext(request))
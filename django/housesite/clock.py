@@ -0,0 +1,40 @@
+"""
+A monotonic clock for timing and scheduling.  Unlike time.time, it never jumps
+when the system clock is set, so deadlines planned with it stay the same
+distance apart.
+"""
+import time
+import ctypes
+import ctypes.util
+
+# This is the value from <time.h> on Linux.
+CLOCK_MONOTONIC = 1
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _load_clock_gettime():
+    for library_name in ("rt", "c"):
+        library_path = ctypes.util.find_library(library_name)
+        if library_path is None:
+            continue
+        clock_gettime = getattr(
+            ctypes.CDLL(library_path, use_errno=True), "clock_gettime", None)
+        if clock_gettime is not None:
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+            return clock_gettime
+    return None
+
+_clock_gettime = _load_clock_gettime()
+
+def monotonic_time():
+    """Return the time in seconds, as a float, from an arbitrary starting
+    point.  If the platform has no monotonic clock, fall back to time.time.
+    """
+    if _clock_gettime is None:
+        return time.time()
+
+    timespec = _Timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+        raise OSError(ctypes.get_errno(), "clock_gettime failed")
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
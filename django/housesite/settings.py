@@ -123,3 +123,12 @@ CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 
 HUELIGHTS_USERNAME = "601e1a2e6923d73995c5861a1be2f3"
 
+# Set this to the bridge's address to skip discovering it.
+HUELIGHTS_BRIDGE_ADDRESS = None
+
+# The iguanaIR device (or igdaemon socket name) used to send and receive IR.
+IRSIGNAL_IGUANA_DEVICE = "0"
+
+# Named groups of WeMo switches that can be turned on or off together, e.g.
+# {"Downstairs lamps": ["Couch Lamp", "Desk Lamp"]}.
+WEMO_SWITCH_GROUPS = {}
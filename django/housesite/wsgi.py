@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "housesite.settings")
 
 application = get_wsgi_application()
+
+# Compile the IR signals up front so the first button presses don't have to
+# query the database.
+import irsignal
+irsignal.load_signal_cache()
+
+# Start looking for WeMo switches in the background.
+import wemo
+wemo.start_discovery()
@@ -1 +1,3 @@
-from models import set_scene
+from models import (
+    set_scene, list_scenes, get_light_states, set_light_states,
+    set_group_states, light_states_changed)
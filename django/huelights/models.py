@@ -1,30 +1,674 @@
 import json
 import urllib
+import socket
+import threading
+import time
+import traceback
+import collections
 
+import requests
+from django import db
 from django.db import models
 from django.conf import settings
+from django.dispatch import Signal
 
 import qhue
 
+class Config(models.Model):
+    # The address of the bridge the last time it was found, so that new
+    # processes don't have to search for it again.
+    bridge_address = models.CharField(max_length=60, null=True, default=None)
+
+    @classmethod
+    def get(cls):
+        configs = cls.objects.all()
+        if len(configs) == 0:
+            config = Config()
+            config.save()
+            return config
+
+        assert len(configs) == 1
+        return configs[0]
+
+    class Meta:
+        app_label = "huelights"
+
+#----------------------------------------------------------------------------
+# Bridge address functions:
+
 _bridge_address = None
 def get_bridge_address():
+    """Return the address of the bridge, as given by the
+    HUELIGHTS_BRIDGE_ADDRESS setting, or as remembered from the last time it
+    was discovered if the bridge still answers there, or by discovering it.
+    """
     global _bridge_address
     if _bridge_address is not None:
         return _bridge_address
 
-    _bridge_address = json.load(
-            urllib.urlopen("http://www.meethue.com/api/nupnp")
-        )[0]["internalipaddress"]
+    bridge_address = getattr(settings, "HUELIGHTS_BRIDGE_ADDRESS", None)
+    if bridge_address is None:
+        bridge_address = Config.get().bridge_address
+        if bridge_address is None or not is_bridge_at_address(bridge_address):
+            bridge_address = discover_bridge_address()
+
+    _bridge_address = bridge_address
     return _bridge_address
 
-_cached_scene_names_to_ids = {}
+def is_bridge_at_address(bridge_address):
+    """Cheaply check if the bridge answers at the given address."""
+    try:
+        response = requests.get(
+            "http://%s/api/config" % bridge_address, timeout=1)
+        return "swversion" in response.json()
+    except (requests.exceptions.RequestException, ValueError, TypeError):
+        return False
+
+def discover_bridge_address():
+    """Find the bridge through the meethue.com discovery service, or if that
+    fails by searching the local network, and remember its address.
+    """
+    bridge_address = _discover_bridge_address_with_nupnp()
+    if bridge_address is None:
+        bridge_address = _discover_bridge_address_with_ssdp()
+    if bridge_address is None:
+        raise RuntimeError("Could not find the Hue bridge")
+
+    config = Config.get()
+    config.bridge_address = bridge_address
+    config.save()
+    return bridge_address
+
+def _discover_bridge_address_with_nupnp():
+    try:
+        bridges = json.load(urllib.urlopen("http://www.meethue.com/api/nupnp"))
+    except (IOError, ValueError):
+        return None
+    return bridges[0]["internalipaddress"] if len(bridges) != 0 else None
+
+def _discover_bridge_address_with_ssdp(timeout_in_s=3):
+    # Multicast an SSDP search and wait for a response from a device that
+    # identifies itself as a Hue bridge.
+    message = "\r\n".join((
+        "M-SEARCH * HTTP/1.1",
+        "HOST: 239.255.255.250:1900",
+        'MAN: "ssdp:discover"',
+        "MX: 2",
+        "ST: ssdp:all",
+        "", ""))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.sendto(message, ("239.255.255.250", 1900))
+
+        end_time = time.time() + timeout_in_s
+        while time.time() < end_time:
+            sock.settimeout(max(end_time - time.time(), 0.01))
+            try:
+                data, (address, port) = sock.recvfrom(4096)
+            except socket.timeout:
+                break
+            if "IpBridge" in data:
+                return address
+    finally:
+        sock.close()
+
+    return None
+
+_is_refreshing_bridge_address = False
+def _refresh_bridge_address_in_background():
+    """Called when the bridge stops answering.  If it doesn't answer at its
+    last known address, discover it again without making the caller wait.
+    """
+    global _is_refreshing_bridge_address
+    if (_is_refreshing_bridge_address or
+            getattr(settings, "HUELIGHTS_BRIDGE_ADDRESS", None) is not None):
+        return
+    _is_refreshing_bridge_address = True
+
+    def refresh():
+        global _bridge_address, _is_refreshing_bridge_address
+        try:
+            if (_bridge_address is None or
+                    not is_bridge_at_address(_bridge_address)):
+                _bridge_address = discover_bridge_address()
+        finally:
+            _is_refreshing_bridge_address = False
+            db.connection.close()
+
+    thread = threading.Thread(target=refresh, name="huelights-discovery")
+    thread.daemon = True
+    thread.start()
+
+_cached_bridge = None
+def _bridge():
+    """Return the bridge, reusing it (and its pooled connections) until its
+    address changes.  The HUELIGHTS_POOL_SIZE, HUELIGHTS_RETRIES and
+    HUELIGHTS_RETRY_BACKOFF_FACTOR settings configure its connections.
+    """
+    global _cached_bridge
+    bridge_address = get_bridge_address()
+    if _cached_bridge is None or _cached_bridge.ip != bridge_address:
+        _cached_bridge = qhue.Bridge(
+            bridge_address, settings.HUELIGHTS_USERNAME,
+            pool_size=getattr(settings, "HUELIGHTS_POOL_SIZE", 10),
+            retries=getattr(settings, "HUELIGHTS_RETRIES", 2),
+            backoff_factor=getattr(
+                settings, "HUELIGHTS_RETRY_BACKOFF_FACTOR", 0.1))
+    return _cached_bridge
+
+def _call_bridge(function):
+    """Call function(bridge), looking for the bridge again if it doesn't
+    answer.
+    """
+    try:
+        return function(_bridge())
+    except requests.exceptions.RequestException:
+        _refresh_bridge_address_in_background()
+        raise
+
+#----------------------------------------------------------------------------
+# Bridge index functions:
+
+class BridgeIndex(object):
+    """Map the names of the bridge's scenes, lights, and groups to their ids,
+    so that looking them up doesn't ask the bridge.
+
+    Once the index is older than TTL_IN_S it is refreshed in the background
+    while lookups keep using the old one.  A name that is missing from the
+    index is remembered as missing for NEGATIVE_TTL_IN_S, so repeated lookups
+    of it fail without asking the bridge each time.
+    """
+    TTL_IN_S = 300
+    NEGATIVE_TTL_IN_S = 30
+    RESOURCE_TYPES = ("scenes", "lights", "groups")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names_to_ids = None
+        self.refresh_time = None
+        self.missing_name_times = {}
+        self.is_refreshing = False
+
+    def id_for_name(self, resource_type, name):
+        names_to_ids = self._names_to_ids(resource_type)
+        if name in names_to_ids:
+            return names_to_ids[name]
+
+        missing_time = self.missing_name_times.get((resource_type, name))
+        if (missing_time is None or
+                time.time() - missing_time > self.NEGATIVE_TTL_IN_S):
+            self.refresh()
+            names_to_ids = self._names_to_ids(resource_type)
+            if name in names_to_ids:
+                return names_to_ids[name]
+            self.missing_name_times[(resource_type, name)] = time.time()
+
+        raise RuntimeError("Invalid %s name: %s" % (resource_type[:-1], name))
+
+    def names(self, resource_type):
+        return sorted(self._names_to_ids(resource_type).keys())
+
+    def refresh(self, full_state=None):
+        """Rebuild the index from the bridge's full state, fetching it in a
+        single request if it isn't given.
+        """
+        if full_state is None:
+            full_state = _call_bridge(lambda bridge: bridge())
+
+        # Bridges with older firmware leave the scenes out of the full state.
+        if "scenes" not in full_state:
+            full_state = dict(full_state,
+                scenes=_call_bridge(lambda bridge: bridge.scenes()))
+
+        names_to_ids = {}
+        for resource_type in self.RESOURCE_TYPES:
+            names_to_ids[resource_type] = dict(
+                (info["name"], resource_id)
+                for resource_id, info in full_state.get(
+                    resource_type, {}).items())
+
+        with self.lock:
+            self.names_to_ids = names_to_ids
+            self.refresh_time = time.time()
+            self.missing_name_times = {}
+
+    def invalidate(self):
+        """Throw the index away, e.g. when the bridge rejects an id from it."""
+        with self.lock:
+            self.names_to_ids = None
+
+    def _names_to_ids(self, resource_type):
+        names_to_ids = self.names_to_ids
+        if names_to_ids is None:
+            self.refresh()
+            names_to_ids = self.names_to_ids
+        elif time.time() - self.refresh_time > self.TTL_IN_S:
+            self._refresh_in_background()
+        return names_to_ids[resource_type]
+
+    def _refresh_in_background(self):
+        with self.lock:
+            if self.is_refreshing:
+                return
+            self.is_refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.is_refreshing = False
+                db.connection.close()
+
+        thread = threading.Thread(target=refresh, name="huelights-index")
+        thread.daemon = True
+        thread.start()
+
+bridge_index = BridgeIndex()
+
+#----------------------------------------------------------------------------
+# Light functions:
+
 def set_scene(scene_name):
-    bridge = qhue.Bridge(get_bridge_address(), settings.HUELIGHTS_USERNAME)
-    if scene_name not in _cached_scene_names_to_ids:
-        for scene_id, scene_info in bridge.scenes().items():
-            _cached_scene_names_to_ids[scene_info["name"]] = scene_id
+    _call_bridge_with_index(
+        lambda bridge: bridge.groups[0].action(
+            scene=bridge_index.id_for_name("scenes", scene_name)))
+
+    # We don't know which lights the scene changed, or to what.
+    state_mirror.forget("groups", 0)
+
+def list_scenes():
+    return bridge_index.names("scenes")
+
+# This signal is sent when the state mirror sees the lights change.
+light_states_changed = Signal()
+
+def get_light_states():
+    """Return a dictionary mapping light names to their states, as last seen
+    by the state mirror.
+    """
+    return state_mirror.light_states()
+
+def _call_bridge_with_index(function):
+    """Call function(bridge), where function looks up ids in the index.  If
+    the bridge rejects the call, its resources may have changed since the
+    index was built, so rebuild the index and try once more.
+    """
+    try:
+        return _call_bridge(function)
+    except qhue.QhueException:
+        bridge_index.invalidate()
+        return _call_bridge(function)
+
+def set_light_states(light_states, transition_time_in_s=None, wait=True):
+    """Change the state of many lights at once.  light_states maps light
+    names to state dictionaries, like {"on": True, "bri": 254, "xy": [x, y]}.
+    """
+    _set_states("lights", light_states, transition_time_in_s, wait)
+
+def set_group_states(group_states, transition_time_in_s=None, wait=True):
+    """Like set_light_states, but for groups of lights."""
+    _set_states("groups", group_states, transition_time_in_s, wait)
+
+def _set_states(resource_type, states_by_name, transition_time_in_s, wait):
+    updates = []
+    for name, state in states_by_name.items():
+        # Don't send values that the lights already have.
+        resource_id = bridge_index.id_for_name(resource_type, name)
+        state = state_mirror.changed_values(resource_type, resource_id, state)
+        if len(state) == 0:
+            continue
+        state_mirror.apply(resource_type, resource_id, state)
+
+        if transition_time_in_s is not None:
+            # The bridge measures transition times in tenths of a second.
+            state["transitiontime"] = int(round(transition_time_in_s * 10))
+        updates.append(
+            (name, state_updater.update(resource_type, resource_id, state)))
+
+    if not wait:
+        return
+
+    errors = []
+    for name, update in updates:
+        if not update.finished.wait(StateUpdater.TIMEOUT_IN_S):
+            errors.append("%s: timed out" % name)
+        elif update.error is not None:
+            errors.append("%s: %s" % (name, update.error))
+    if len(errors) != 0:
+        raise RuntimeError("Could not set the state of %s" % ", ".join(errors))
+
+#----------------------------------------------------------------------------
+# State update functions:
+
+class TokenBucket(object):
+    """Allow bursts of up to capacity operations, with tokens for more
+    operations added at rate tokens per second.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait until a token is available and take it."""
+        with self.lock:
+            while True:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+# These are the ranges of the values that increments (e.g. bri_inc) change, and
+# of the increments themselves, from the bridge's documentation.  Hue wraps
+# around instead of stopping at its limits.
+VALUE_RANGES = {
+    "bri": (1, 254),
+    "sat": (0, 254),
+    "hue": (0, 65535),
+    "ct": (153, 500),
+    "xy": (0, 1),
+}
+INCREMENT_RANGES = {
+    "bri": (-254, 254),
+    "sat": (-254, 254),
+    "hue": (-65534, 65534),
+    "ct": (-65534, 65534),
+    "xy": (-0.5, 0.5),
+}
+
+def merge_states(state, new_state):
+    """Merge new_state into state, so that sending state has the same effect
+    as sending the old state and then new_state.  Newer values replace older
+    ones, but increments (e.g. bri_inc) add to older increments, or to the
+    older value if it was set.
+    """
+    for key, value in new_state.items():
+        if not key.endswith("_inc"):
+            state[key] = value
+            # The bridge ignores increments when the value is also given.
+            state.pop(key + "_inc", None)
+            continue
+
+        value_key = key[:-len("_inc")]
+        if value_key in state:
+            state[value_key] = _add_increment(state[value_key], value,
+                VALUE_RANGES.get(value_key), wraps=(value_key == "hue"))
+        elif key in state:
+            state[key] = _add_increment(
+                state[key], value, INCREMENT_RANGES.get(value_key))
+        else:
+            state[key] = value
+
+def _add_increment(value, increment, value_range, wraps=False):
+    if isinstance(value, list):
+        return [_add_increment(coordinate, coordinate_increment, value_range)
+            for coordinate, coordinate_increment in zip(value, increment)]
+
+    result = value + increment
+    if value_range is None:
+        return result
+    minimum, maximum = value_range
+    if wraps:
+        return minimum + (result - minimum) % (maximum - minimum + 1)
+    return min(max(result, minimum), maximum)
+
+class PendingStateUpdate(object):
+    def __init__(self):
+        self.state = {}
+        self.finished = threading.Event()
+        self.error = None
+
+class StateUpdater(object):
+    """Send state updates for lights and groups to the bridge from a few
+    threads at once, while keeping within the bridge's documented rate limits
+    of about ten light updates and one group update per second.
+
+    An update for a light or group that is still waiting to be sent is merged
+    into the waiting one (see merge_states), and updates for the same light or
+    group are never sent at the same time.
+    """
+    NUM_THREADS = 4
+    TIMEOUT_IN_S = 30
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending_updates = collections.OrderedDict()
+        self.keys_being_sent = set()
+        self.token_buckets = {
+            "lights": TokenBucket(rate=10, capacity=10),
+            "groups": TokenBucket(rate=1, capacity=1),
+        }
+        self.threads = None
+
+    def update(self, resource_type, resource_id, state):
+        """Queue a state update and return its PendingStateUpdate."""
+        key = (resource_type, resource_id)
+        with self.condition:
+            self._start()
+            pending_update = self.pending_updates.get(key)
+            if pending_update is None:
+                pending_update = PendingStateUpdate()
+                self.pending_updates[key] = pending_update
+                self.condition.notify_all()
+            merge_states(pending_update.state, state)
+        return pending_update
+
+    def _start(self):
+        if self.threads is not None:
+            return
+
+        self.threads = [
+            threading.Thread(target=self._run, name="huelights-updater")
+            for i in range(self.NUM_THREADS)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                key = self._next_key()
+                while key is None:
+                    self.condition.wait()
+                    key = self._next_key()
+                pending_update = self.pending_updates.pop(key)
+                self.keys_being_sent.add(key)
+
+            try:
+                self._send(key, pending_update)
+            except Exception as e:
+                pending_update.error = e
+
+                # The state mirror assumed the update would succeed.
+                state_mirror.forget(*key)
+            else:
+                # A poll that started before the update was sent wouldn't
+                # see its effects.
+                if not state_mirror.can_mirror(pending_update.state):
+                    state_mirror.forget(*key)
+            finally:
+                pending_update.finished.set()
+                with self.condition:
+                    self.keys_being_sent.remove(key)
+                    self.condition.notify_all()
+
+    def _next_key(self):
+        for key in self.pending_updates:
+            if key not in self.keys_being_sent:
+                return key
+        return None
+
+    def _send(self, key, pending_update):
+        resource_type, resource_id = key
+        self.token_buckets[resource_type].take()
+        _call_bridge(lambda bridge:
+            bridge[resource_type][resource_id][
+                "state" if resource_type == "lights" else "action"](
+                    **pending_update.state))
+
+state_updater = StateUpdater()
+
+#----------------------------------------------------------------------------
+# State mirror functions:
+
+class StateMirror(object):
+    """A local copy of the state of the bridge's lights and groups, so that
+    reading their state, and checking if they are already in a state, doesn't
+    ask the bridge.
+
+    A background thread fetches the bridge's full state in a single request
+    every HUELIGHTS_POLL_INTERVAL_IN_S seconds, which also refreshes the
+    bridge index.  Our own updates are applied to the copy as soon as they
+    are queued, assuming they will succeed.
+
+    A light's mirrored state is only trusted to skip writes if it was polled
+    less than HUELIGHTS_MAX_MIRROR_AGE_IN_S ago (which bounds how long a
+    change made by something else, like the Hue app, can make us skip a write
+    that was needed), and nothing has happened to it since that we can't
+    mirror, like a scene, an increment, or a failed update.
+    """
+    # These values trigger actions instead of setting state, so they are
+    # always sent and never recorded.
+    ACTION_KEYS = frozenset(("alert", "scene", "transitiontime"))
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.full_state = None
+        self.poll_time = None
+        self.forget_times = {}
+        self.poll_event = threading.Event()
+        self.thread = None
+
+    def light_states(self):
+        full_state = self._full_state()
+        return dict(
+            (info["name"], dict(info["state"]))
+            for info in full_state.get("lights", {}).values())
+
+    def changed_values(self, resource_type, resource_id, state):
+        """Return the values in the state that differ from the current state
+        of the light, or of any light in the group.  If the current state of
+        any of the lights isn't known, all the values are returned.
+        """
+        light_ids = self._light_ids(resource_type, resource_id)
+        if len(light_ids) == 0 or not all(
+                self._is_known(light_id) for light_id in light_ids):
+            return dict(state)
+
+        current_states = self._current_states(light_ids)
+        return dict(
+            (key, value) for key, value in state.items()
+            if key in self.ACTION_KEYS or key.endswith("_inc") or
+                any(current_state.get(key) != value
+                    for current_state in current_states))
+
+    def apply(self, resource_type, resource_id, state):
+        light_ids = self._light_ids(resource_type, resource_id)
+        with self.lock:
+            for current_state in self._current_states(light_ids):
+                current_state.update(
+                    (key, value) for key, value in state.items()
+                    if key not in self.ACTION_KEYS and
+                        not key.endswith("_inc"))
+
+        if not self.can_mirror(state):
+            self.forget(resource_type, resource_id)
+        light_states_changed.send(sender=None)
+
+    def can_mirror(self, state):
+        """Return whether applying the state tells us what the lights were
+        changed to, which increments and scenes don't.
+        """
+        return not any(
+            key.endswith("_inc") or key == "scene" for key in state)
+
+    def forget(self, resource_type, resource_id):
+        """Note that the state of the light, or of the lights in the group,
+        is unknown until the next poll, and poll soon.
+        """
+        forget_time = time.time()
+        with self.lock:
+            for light_id in self._light_ids(resource_type, resource_id):
+                self.forget_times[light_id] = forget_time
+        self.poll_soon()
+
+    def poll(self):
+        poll_time = time.time()
+        full_state = _call_bridge(lambda bridge: bridge())
+        with self.lock:
+            old_full_state = self.full_state
+            self.full_state = full_state
+            self.poll_time = poll_time
+            for light_id, forget_time in self.forget_times.items():
+                if forget_time < poll_time:
+                    del self.forget_times[light_id]
+        bridge_index.refresh(full_state)
+
+        if (old_full_state is not None and
+                old_full_state.get("lights") != full_state.get("lights")):
+            light_states_changed.send(sender=None)
+
+    def poll_soon(self):
+        if self.thread is not None:
+            self.poll_event.set()
+
+    def _light_ids(self, resource_type, resource_id):
+        full_state = self._full_state()
+        lights = full_state.get("lights", {})
+        if resource_type == "lights":
+            light_ids = [str(resource_id)]
+        elif str(resource_id) == "0":
+            # Group 0 contains all the lights and isn't in the full state.
+            light_ids = lights.keys()
+        else:
+            light_ids = full_state.get("groups", {}).get(
+                str(resource_id), {}).get("lights", [])
+        return [light_id for light_id in light_ids if light_id in lights]
+
+    def _current_states(self, light_ids):
+        lights = self._full_state().get("lights", {})
+        return [lights[light_id]["state"] for light_id in light_ids]
+
+    def _is_known(self, light_id):
+        return (light_id not in self.forget_times and
+            time.time() - self.poll_time < getattr(
+                settings, "HUELIGHTS_MAX_MIRROR_AGE_IN_S", 5))
+
+    def _full_state(self):
+        if self.full_state is None:
+            self.poll()
+        self._start()
+        return self.full_state
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(
+                target=self._run, name="huelights-mirror")
+            self.thread.daemon = True
+            self.thread.start()
 
-        if scene_name not in _cached_scene_names_to_ids:
-            raise RuntimeError("Invalid scene name")
+    def _run(self):
+        while True:
+            self.poll_event.wait(
+                getattr(settings, "HUELIGHTS_POLL_INTERVAL_IN_S", 10))
+            self.poll_event.clear()
+            try:
+                self.poll()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                db.connection.close()
 
-    bridge.groups[0].action(scene=_cached_scene_names_to_ids[scene_name])
+state_mirror = StateMirror()
@@ -2,15 +2,19 @@
 # but distributed under the GPL v2.
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import json
 
 class QhueException(Exception):
     pass
 
 class Resource(object):
-    def __init__(self, url, timeout=5):
+    def __init__(self, url, timeout=5, session=None):
         self.url = url
         self.timeout = timeout
+        self.session = session if session is not None else requests
+        self._children = {}
 
     def __call__(self, *args, **kwargs):
         url = self.url
@@ -19,13 +23,13 @@ class Resource(object):
         http_method = kwargs.pop('http_method',
             'get' if not kwargs else 'put').lower()
         if http_method == 'put':
-            r = requests.put(url, data=json.dumps(kwargs, default=list), timeout=self.timeout)
+            r = self.session.put(url, data=json.dumps(kwargs, default=list), timeout=self.timeout)
         elif http_method == 'post':
-            r = requests.post(url, data=json.dumps(kwargs, default=list), timeout=self.timeout)
+            r = self.session.post(url, data=json.dumps(kwargs, default=list), timeout=self.timeout)
         elif http_method == 'delete':
-            r = requests.delete(url, timeout=self.timeout)
+            r = self.session.delete(url, timeout=self.timeout)
         else:
-            r = requests.get(url, timeout=self.timeout)
+            r = self.session.get(url, timeout=self.timeout)
         if r.status_code != 200:
             raise QhueException("Received response {c} from {u}".format(c=r.status_code, u=url))
         resp = r.json()
@@ -36,16 +40,41 @@ class Resource(object):
         return resp
         
     def __getattr__(self, name):
-        return Resource(self.url + "/" + str(name), timeout=self.timeout)
+        # Sub-resources are kept, so repeatedly walking the same path doesn't
+        # create new objects.
+        name = str(name)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        child = self._children.get(name)
+        if child is None:
+            child = Resource(self.url + "/" + name,
+                timeout=self.timeout, session=self.session)
+            self._children[name] = child
+        return child
 
     __getitem__ = __getattr__
     
 
 class Bridge(Resource):
-    def __init__(self, ip, username=None, timeout=5):
+    """The bridge's resources share one session, so calls reuse keep-alive
+    connections from a pool of up to pool_size connections.  Requests that
+    fail to connect are retried up to retries times, waiting backoff_factor
+    seconds before the first retry and doubling the wait after that.
+    Requests that reached the bridge aren't retried, even if the response
+    never came, since state changes like bri_inc, alert and scene recalls
+    would be applied twice.
+    """
+    def __init__(self, ip, username=None, timeout=5,
+            pool_size=10, retries=2, backoff_factor=0.1):
         self.ip = ip
         self.username = username
         url = "http://{i}/api".format(i = self.ip)
         if username: 
             url += "/{u}".format(u=username)
-        super(Bridge, self).__init__(url, timeout=timeout)
+
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries, read=0, backoff_factor=backoff_factor)))
+        super(Bridge, self).__init__(url, timeout=timeout, session=session)
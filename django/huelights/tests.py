@@ -1,3 +1,182 @@
-from django.test import TestCase
+import json
+import copy
+import threading
+import BaseHTTPServer
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+
+from huelights import models
+
+USERNAME = "testuser"
+
+INITIAL_FULL_STATE = {
+    "config": {"swversion": "01041302"},
+    "lights": {
+        "1": {"name": "Couch", "state": {"on": True, "bri": 200, "ct": 366}},
+        "2": {"name": "Desk", "state": {"on": False, "bri": 100, "ct": 366}},
+    },
+    "groups": {
+        "1": {"name": "Living room", "lights": ["1", "2"]},
+    },
+    "scenes": {
+        "relax-id": {"name": "Relax", "lights": ["1", "2"]},
+    },
+}
+
+# The states that the bridge sets the lights to when the scene is recalled.
+SCENE_LIGHT_STATES = {
+    "relax-id": {"1": {"on": True, "bri": 144}, "2": {"on": True, "bri": 144}},
+}
+
+class FakeBridge(object):
+    """A local HTTP server that stands in for the Hue bridge, keeping the
+    lights' state and recording the state updates it receives.
+    """
+    def __init__(self):
+        self.full_state = copy.deepcopy(INITIAL_FULL_STATE)
+        self.lock = threading.Lock()
+        self.updates = []
+        self.num_full_state_requests = 0
+
+        fake_bridge = self
+        class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(fake_bridge.get(self.path))
+
+            def do_PUT(self):
+                body = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"])))
+                self.respond(fake_bridge.put(self.path, body))
+
+            def respond(self, value):
+                data = json.dumps(value)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(
+            ("127.0.0.1", 0), RequestHandler)
+        self.address = "127.0.0.1:%s" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        parts = path.strip("/").split("/")
+        if parts == ["api", "config"]:
+            return self.full_state["config"]
+
+        assert parts == ["api", USERNAME], path
+        with self.lock:
+            self.num_full_state_requests += 1
+            return copy.deepcopy(self.full_state)
+
+    def put(self, path, body):
+        api, username, resource_type, resource_id, action = (
+            path.strip("/").split("/"))
+        with self.lock:
+            self.updates.append((resource_type, resource_id, body))
+            if resource_type == "lights":
+                light_ids = [resource_id]
+            elif resource_id == "0":
+                light_ids = self.full_state["lights"].keys()
+            else:
+                light_ids = self.full_state["groups"][resource_id]["lights"]
+
+            body = dict(body)
+            scene_id = body.pop("scene", None)
+            for light_id in light_ids:
+                state = self.full_state["lights"][light_id]["state"]
+                if scene_id is not None:
+                    state.update(SCENE_LIGHT_STATES[scene_id].get(light_id, {}))
+                for key, value in body.items():
+                    if key.endswith("_inc"):
+                        state[key[:-len("_inc")]] += value
+                    elif key != "transitiontime":
+                        state[key] = value
+        return [{"success": {path: True}}]
+
+    def set_light_state(self, light_id, **state):
+        """Change a light's state the way another app would."""
+        with self.lock:
+            self.full_state["lights"][light_id]["state"].update(state)
+
+    def light_updates(self):
+        with self.lock:
+            return [update for update in self.updates if update[0] == "lights"]
+
+class StateMirrorTest(TestCase):
+    def setUp(self):
+        self.bridge = FakeBridge()
+        self.settings_override = override_settings(
+            HUELIGHTS_BRIDGE_ADDRESS=self.bridge.address,
+            HUELIGHTS_USERNAME=USERNAME,
+            HUELIGHTS_POLL_INTERVAL_IN_S=3600,
+            HUELIGHTS_MAX_MIRROR_AGE_IN_S=3600)
+        self.settings_override.enable()
+
+        # Start from a clean slate, so nothing is left from other tests.
+        models._bridge_address = None
+        models._cached_bridge = None
+        models.bridge_index = models.BridgeIndex()
+        models.state_mirror = models.StateMirror()
+        models.state_updater = models.StateUpdater()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.bridge.stop()
+
+    def test_reads_come_from_the_mirror(self):
+        self.assertEqual(models.get_light_states()["Couch"]["bri"], 200)
+        self.assertEqual(models.get_light_states()["Desk"]["on"], False)
+        self.assertEqual(self.bridge.num_full_state_requests, 1)
+
+    def test_redundant_writes_are_skipped(self):
+        models.set_light_states({"Couch": {"on": True, "bri": 200}})
+        self.assertEqual(self.bridge.light_updates(), [])
+
+    def test_changed_values_are_written(self):
+        models.set_light_states({"Couch": {"on": True, "bri": 50}})
+        self.assertEqual(
+            self.bridge.light_updates(), [("lights", "1", {"bri": 50})])
+        self.assertEqual(models.get_light_states()["Couch"]["bri"], 50)
+
+        # The mirror applied our write, so repeating it is skipped.
+        models.set_light_states({"Couch": {"bri": 50}})
+        self.assertEqual(len(self.bridge.light_updates()), 1)
+
+    def test_writes_after_a_scene_are_written(self):
+        models.set_scene("Relax")
+        models.set_light_states({"Couch": {"bri": 200}})
+        self.assertEqual(self.bridge.full_state["lights"]["1"]["state"]["bri"],
+            200)
+
+    def test_writes_after_an_increment_are_written(self):
+        models.set_light_states({"Couch": {"bri_inc": -20}})
+        models.set_light_states({"Couch": {"bri": 200}})
+        self.assertEqual(self.bridge.full_state["lights"]["1"]["state"]["bri"],
+            200)
+
+    def test_writes_are_not_skipped_when_the_mirror_is_old(self):
+        models.get_light_states()
+        self.bridge.set_light_state("1", bri=10)
+        with self.settings(HUELIGHTS_MAX_MIRROR_AGE_IN_S=0):
+            models.set_light_states({"Couch": {"bri": 200}})
+        self.assertEqual(self.bridge.full_state["lights"]["1"]["state"]["bri"],
+            200)
+
+    def test_group_writes_check_every_light(self):
+        models.set_group_states({"Living room": {"on": True}})
+        self.assertEqual(
+            self.bridge.updates, [("groups", "1", {"on": True})])
+        models.set_group_states({"Living room": {"on": True}})
+        self.assertEqual(len(self.bridge.updates), 1)
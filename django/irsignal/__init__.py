@@ -1 +1,4 @@
-from models import press_button, is_busy
+from models import (
+    press_button, queue_button_press, hold_button, release_button,
+    load_signal_cache, IRError, IRSendError, get_last_pressed_buttons,
+    button_pressed)
@@ -1,4 +1,4 @@
-from irsignal.models import ProntoCode
+from irsignal.models import ProntoCode, save_button
 
 def add_buttons():
     add_code_if_missing("denon-avr3806", "power_on", "0000 006D 0000 0020 000A 001E 000A 0046 000A 001E 000A 001E 000A 001E 000A 0046 000A 001E 000A 001E 000A 001E 000A 001E 000A 0046 000A 0046 000A 0046 000A 001E 000A 001E 000A 0677 000A 001E 000A 0046 000A 001E 000A 001E 000A 001E 000A 001E 000A 0046 000A 0046 000A 0046 000A 0046 000A 001E 000A 001E 000A 001E 000A 0046 000A 0046 000A 0677")
@@ -18,7 +18,7 @@ def add_code_if_missing(device, button, pronto_code):
     try:
         ProntoCode.objects.get(device=device, button=button)
     except ProntoCode.DoesNotExist:
-        ProntoCode(device=device, button=button, pronto_code=pronto_code).save()
+        save_button(device, button, pronto_code)
 
 if __name__ == "__main__":
     add_buttons()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from irsignal import models
+
+class Command(BaseCommand):
+    help = ("Stores the saved infrared signals that are in a known protocol"
+        " in their compact form.")
+
+    def handle(self, *args, **options):
+        for pronto_code in models.ProntoCode.objects.filter(protocol=""):
+            compact_code = models.decode_pronto_code(pronto_code.pronto_code)
+            if compact_code is None:
+                self.stdout.write("%s: not in a known protocol" % pronto_code)
+                continue
+
+            models.save_compact_button(
+                pronto_code.device, pronto_code.button, *compact_code)
+            self.stdout.write("%s: %s device %s key %s" % (
+                (pronto_code,) + tuple(compact_code)))
@@ -14,7 +14,7 @@ class Command(BaseCommand):
             help="The name of the button on the remote")
         parser.add_argument("code_type",
             help="The type of code",
-            choices=("NEC", "RC5"))
+            choices=("NEC", "RC5", "Denon"))
         parser.add_argument("device_address",
             help="The device address specified by the manufacturer",
             type=int)
@@ -23,13 +23,6 @@ class Command(BaseCommand):
             type=int)
 
     def handle(self, *args, **options):
-        if options["code_type"].lower() == "nec":
-            pronto_code = models.nec_code_to_pronto_code(
-                options["device_address"], options["key_code"])
-        elif options["code_type"].lower() == "rc5":
-            pronto_code = models.philips_rc5_to_pronto_code(
-                options["device_address"], options["key_code"])
-        else:
-            assert not "Invalid choices for the code type argument"
-
-        models.save_button(options["device"], options["button"], pronto_code)
+        models.save_compact_button(options["device"], options["button"],
+            options["code_type"].lower(), options["device_address"],
+            options["key_code"])
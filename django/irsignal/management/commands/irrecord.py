@@ -14,4 +14,17 @@ class Command(BaseCommand):
             help="The name of the button on the remote")
 
     def handle(self, *args, **options):
-        models.record_button(options["device"], options["button"])
+        pronto_code = models.record_button(
+            options["device"], options["button"])
+        if pronto_code.protocol:
+            self.stdout.write("Recorded %s code with device address %s and"
+                " key code %s" % (pronto_code.protocol,
+                    pronto_code.device_address, pronto_code.key_code))
+            return
+
+        carrier_frequency = pronto_code.pronto_sequences()[0]
+        self.stdout.write("Recorded with a carrier frequency of %s Hz" %
+            carrier_frequency)
+        if pronto_code.carrier_confidence == 0:
+            self.stdout.write("The code isn't in a known protocol, so its"
+                " carrier frequency isn't known and the default was used.")
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('irsignal', '0002_config'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='Config',
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('irsignal', '0003_delete_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prontocode',
+            name='carrier_confidence',
+            field=models.FloatField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('irsignal', '0004_prontocode_carrier_confidence'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='prontocode',
+            name='pronto_code',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='prontocode',
+            name='protocol',
+            field=models.CharField(max_length=10, blank=True),
+        ),
+        migrations.AddField(
+            model_name='prontocode',
+            name='device_address',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='prontocode',
+            name='key_code',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+    ]
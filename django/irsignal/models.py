@@ -2,43 +2,66 @@ import sys
 import os
 import itertools
 import json
-import struct
 import ctypes
 import socket
-
+import threading
+import time
+import collections
+import traceback
+import fcntl
+import tempfile
+import array
+import binascii
+import contextlib
+
+from django.conf import settings
 from django.db import models
-from django.utils import timezone
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
 import iguanaIR
 
+from housesite.clock import monotonic_time
+
 DEFAULT_CARRIER_FREQUENCY = 38000
 
 class ProntoCode(models.Model):
     device = models.CharField(max_length=60)
     button = models.CharField(max_length=60)
-    pronto_code = models.TextField()
+    pronto_code = models.TextField(blank=True)
 
-    def __unicode__(self):
-        return "%s %s" % (self.device, self.button)
+    # Codes in a known protocol are stored compactly instead, as the protocol
+    # name (a key of PROTOCOL_ENCODERS), device address, and key code, and the
+    # pronto code is left empty.
+    protocol = models.CharField(max_length=10, blank=True)
+    device_address = models.IntegerField(null=True, blank=True)
+    key_code = models.IntegerField(null=True, blank=True)
 
-    class Meta:
-        unique_together = (("device", "button"),)
-        app_label = "irsignal"
+    # For recorded codes, 1 if the carrier frequency came from decoding the
+    # code as a known protocol, or 0 if the default was used (see
+    # estimate_carrier_frequency).  Imported codes have none.
+    carrier_confidence = models.FloatField(null=True, blank=True)
+
+    # This lets other processes notice that the code changed (see
+    # _check_signal_cache).
+    updated_at = models.DateTimeField(auto_now=True)
 
-class Config(models.Model):
-    busy_start_time = models.DateTimeField(null=True, default=None)
+    def __unicode__(self):
+        return "%s %s" % (self.device, self.button)
 
-    @classmethod
-    def get(cls):
-        configs = cls.objects.all()
-        if len(configs) == 0:
-            config = Config()
-            config.save()
-            return config
+    def pronto_sequences(self):
+        """Return (carrier_frequency, seq1, seq2) for the code, however it is
+        stored.
+        """
+        return _pronto_sequences_for_code(self.pronto_code,
+            self.protocol, self.device_address, self.key_code)
 
-        assert len(configs) == 1
-        return configs[0]
+    def to_pronto_code(self):
+        if not self.protocol:
+            return self.pronto_code
+        return pronto_signals_to_pronto_code(*self.pronto_sequences())
 
     class Meta:
+        unique_together = (("device", "button"),)
         app_label = "irsignal"
 
 #----------------------------------------------------------------------------
@@ -52,51 +75,260 @@ class IRError(Exception):
             message += " (errno %s)" % self.errno
         super(IRError, self).__init__(message)
 
+class IRSendError(IRError):
+    """The signals were written to the device, but it didn't confirm that it
+    sent them.  They may have gone out anyway, so they must not be sent again:
+    sending a power toggle code twice would cancel it out.
+    """
+
+# This signal is sent after a button's signal was sent to a device.
+button_pressed = Signal(providing_args=["device_name", "button_name"])
+
 def press_button(device_name, button_name, repeat=1):
-    """Send the signal for the given button to the given device."""
-    carrier_frequency, signals = get_iguana_signals_for_button(
+    """Send the signal for the given button to the given device.  See also
+    queue_button_press.
+    """
+    carrier_frequency, payload = get_iguana_payload_for_button(
         device_name, button_name, repeat)
-    send_iguana_signals(carrier_frequency, signals)
+    send_iguana_payload(carrier_frequency, payload)
+    _pressed_button(device_name, button_name)
 
-def record_button(device_name, button_name):
-    """Record the signal for a button, saving it to disk for later use."""
-    pronto_code = record_pronto_code()
-    save_button(device_name, button_name, pronto_code)
+# This maps device names to the last button pressed for them, and when.
+_last_pressed_buttons = {}
 
-def is_busy():
-    config = Config.get()
-    return (config.busy_start_time is not None and
-        (timezone.now() - config.busy_start_time).total_seconds() < 5)
+def get_last_pressed_buttons():
+    """Return a dictionary mapping device names to dictionaries with the name
+    of the last button pressed for the device and the time it was pressed.
+    """
+    return dict(_last_pressed_buttons)
+
+def _pressed_button(device_name, button_name):
+    _last_pressed_buttons[device_name] = {
+        "button": button_name,
+        "time": time.time(),
+    }
+    button_pressed.send(sender=None,
+        device_name=device_name, button_name=button_name)
+
+def record_button(device_name, button_name):
+    """Record the signal for a button, saving it to disk for later use.
+    Returns the saved ProntoCode.
+    """
+    pronto_code, carrier_confidence = record_pronto_code()
+    return save_button(
+        device_name, button_name, pronto_code, carrier_confidence)
 
 #----------------------------------------------------------------------------
 # IR code storage functions:
 
+# The signal cache is process-wide.  _cached_pronto_sequences maps
+# (device_name, button_name) to the code's (carrier_frequency, seq1, seq2),
+# and _cached_iguana_payloads maps
+# (device_name, button_name, repeat) to (carrier_frequency, payload), where the
+# payload is the packed data that is sent as-is to the device.  Saving or
+# deleting a ProntoCode evicts its entries right away in the process that made
+# the change.  Other processes (e.g. apache after running irimport or
+# irrecord) notice the change the next time they use the cache after
+# SIGNAL_CACHE_CHECK_INTERVAL_IN_S has passed, with a single cheap query.
+SIGNAL_CACHE_CHECK_INTERVAL_IN_S = 2
+
+_cached_pronto_sequences = {}
+_cached_iguana_payloads = {}
+_is_signal_cache_loaded = False
+_signal_cache_lock = threading.Lock()
+_signal_cache_fingerprint = None
+_signal_cache_check_time = None
+
+def load_signal_cache():
+    """Load all the pronto codes with a single query and compile the payloads
+    for single presses, so the first press of each button doesn't need to
+    touch the database.
+    """
+    global _is_signal_cache_loaded, _signal_cache_fingerprint, \
+        _signal_cache_check_time
+    _signal_cache_fingerprint = _get_signal_cache_fingerprint()
+    _signal_cache_check_time = monotonic_time()
+    _cached_pronto_sequences.clear()
+    _cached_iguana_payloads.clear()
+    for device_name, button_name, pronto_code, protocol, device_address, \
+            key_code in ProntoCode.objects.values_list(
+                "device", "button", "pronto_code", "protocol",
+                "device_address", "key_code"):
+        pronto_sequences = _pronto_sequences_for_code(
+            pronto_code, protocol, device_address, key_code)
+        _cached_pronto_sequences[(device_name, button_name)] = (
+            pronto_sequences)
+        _compile_iguana_payload(device_name, button_name, pronto_sequences, 1)
+    _is_signal_cache_loaded = True
+
+def get_iguana_payload_for_button(device_name, button_name, repeat=1):
+    """Get the packed iguana payload for a button on a device, retrieving it
+    from cache if it was already compiled.
+
+    Returns (carrier_frequency, payload).
+    """
+    _check_signal_cache()
+    key = (device_name, button_name, repeat)
+    result = _cached_iguana_payloads.get(key)
+    if result is not None:
+        return result
+
+    return _compile_iguana_payload(
+        device_name, button_name,
+        _get_pronto_sequences_for_button(device_name, button_name), repeat)
+
+def get_iguana_hold_payloads_for_button(device_name, button_name):
+    """Get the packed iguana payloads used to hold a button down, retrieving
+    them from cache if they were already compiled.
+
+    Returns a HoldPayloads.
+    """
+    _check_signal_cache()
+    key = (device_name, button_name, "hold")
+    result = _cached_iguana_payloads.get(key)
+    if result is None:
+        result = pronto_sequences_to_iguana_hold_payloads(
+            *_get_pronto_sequences_for_button(device_name, button_name))
+        _cached_iguana_payloads[key] = result
+    return result
+
 def get_iguana_signals_for_button(device_name, button_name, repeat=1):
-    """Get the iguana signal for a button on a device, retrieving it from
-    cache if the device's buttons have been loaded in.
+    """Get the iguana signal for a button on a device.
 
     Returns (carrier_sequence, signals).
     """
-    # The pronto codes are stored as space/newline separated hexadecimal values.
-    return pronto_code_to_iguana_signals(
-        ProntoCode.objects.get(
-            device=device_name, button=button_name).pronto_code,
-        repeat)
+    carrier_frequency, seq1, seq2 = _get_pronto_sequences_for_button(
+        device_name, button_name)
+    return (carrier_frequency, pronto_signals_to_iguana_signals(
+        carrier_frequency, (seq1 + seq2 * repeat)[:-1]))
+
+def _check_signal_cache():
+    """Load the signal cache if it isn't loaded, or reload it if another
+    process changed the codes since it was loaded.  The database is checked at
+    most once every SIGNAL_CACHE_CHECK_INTERVAL_IN_S.
+    """
+    global _signal_cache_check_time
+    with _signal_cache_lock:
+        if not _is_signal_cache_loaded:
+            load_signal_cache()
+            return
+
+        if monotonic_time() - _signal_cache_check_time < (
+                SIGNAL_CACHE_CHECK_INTERVAL_IN_S):
+            return
+
+        _signal_cache_check_time = monotonic_time()
+        if _get_signal_cache_fingerprint() != _signal_cache_fingerprint:
+            load_signal_cache()
+
+def _get_signal_cache_fingerprint():
+    # Saves change the latest update time, save_button inserts a new row with
+    # a new id, and deletes change the count.  The update time alone isn't
+    # enough, since MySQL only stores it to the second.
+    return tuple(sorted(ProntoCode.objects.aggregate(
+        count=models.Count("id"),
+        max_id=models.Max("id"),
+        max_updated_at=models.Max("updated_at")).items()))
+
+def _get_pronto_sequences_for_button(device_name, button_name):
+    _check_signal_cache()
+    pronto_sequences = _cached_pronto_sequences.get((device_name, button_name))
+    if pronto_sequences is None:
+        pronto_sequences = ProntoCode.objects.get(
+            device=device_name, button=button_name).pronto_sequences()
+        _cached_pronto_sequences[(device_name, button_name)] = (
+            pronto_sequences)
+    return pronto_sequences
+
+def _pronto_sequences_for_code(pronto_code, protocol, device_address,
+        key_code):
+    # Compact codes are encoded directly, without going through hexadecimal
+    # text.  Other pronto codes are stored as space/newline separated
+    # hexadecimal values.
+    if protocol:
+        return PROTOCOL_ENCODERS[protocol](device_address, key_code)
+    return pronto_parts_to_pronto_sequences(
+        pronto_code_to_pronto_array(pronto_code))
+
+def _compile_iguana_payload(device_name, button_name, pronto_sequences,
+        repeat):
+    carrier_frequency, seq1, seq2 = pronto_sequences
+    result = pronto_sequences_to_iguana_payload(
+        carrier_frequency, seq1, seq2, repeat)
+    _cached_iguana_payloads[(device_name, button_name, repeat)] = result
+    return result
+
+def _evict_button_from_signal_cache(device_name, button_name):
+    _cached_pronto_sequences.pop((device_name, button_name), None)
+    for key in _cached_iguana_payloads.keys():
+        if key[:2] == (device_name, button_name):
+            _cached_iguana_payloads.pop(key, None)
+
+@receiver(post_save, sender=ProntoCode)
+@receiver(post_delete, sender=ProntoCode)
+def _on_pronto_code_changed(sender, instance, **kwargs):
+    _evict_button_from_signal_cache(instance.device, instance.button)
+
+def save_button(device_name, button_name, pronto_code,
+        carrier_confidence=None):
+    """Save a pronto code for a button, in its compact form if it decodes as
+    a known protocol.  Returns the saved ProntoCode.
+    """
+    compact_code = decode_pronto_code(pronto_code)
+    if compact_code is not None:
+        return save_compact_button(
+            device_name, button_name, *compact_code)
 
-def save_button(device_name, button_name, pronto_code):
-    ProntoCode.objects.filter(device=device_name, button=button_name).delete()
-    ProntoCode(
+    return _save_pronto_code(ProntoCode(
         device=device_name,
         button=button_name,
         pronto_code=pronto_code,
-    ).save()
+        carrier_confidence=carrier_confidence,
+    ))
+
+def save_compact_button(device_name, button_name, protocol, device_address,
+        key_code):
+    """Save a code given by its protocol (a key of PROTOCOL_ENCODERS), device
+    address, and key code.  Returns the saved ProntoCode.
+    """
+    if protocol not in PROTOCOL_ENCODERS:
+        raise ValueError("Unknown IR protocol: %s" % protocol)
+
+    return _save_pronto_code(ProntoCode(
+        device=device_name,
+        button=button_name,
+        protocol=protocol,
+        device_address=device_address,
+        key_code=key_code,
+    ))
+
+def _save_pronto_code(pronto_code):
+    ProntoCode.objects.filter(
+        device=pronto_code.device, button=pronto_code.button).delete()
+    pronto_code.save()
+    return pronto_code
 
 #----------------------------------------------------------------------------
 # Pronto code functions:
 
 def pronto_code_to_pronto_signals(pronto_code, repeat=1):
-    parts = [int(part, 16) for part in pronto_code.split()]
+    return pronto_parts_to_pronto_signals(
+        [int(part, 16) for part in pronto_code.split()], repeat)
+
+def pronto_parts_to_pronto_signals(parts, repeat=1):
+    """Given the numeric values of a pronto code, as a list or an array,
+    return the carrier frequency and the signals, of the same type as parts.
+    """
+    carrier_frequency, seq1, seq2 = pronto_parts_to_pronto_sequences(parts)
+
+    # Note that signals contain (pulse, space) pairs, but we discard the last
+    # space.
+    return carrier_frequency, (seq1 + seq2 * repeat)[:-1]
 
+def pronto_parts_to_pronto_sequences(parts):
+    """Given the numeric values of a pronto code, return the carrier
+    frequency, the non-repeating sequence, and the repeating sequence.
+    """
     # The first value is always zero.  The second is an encoding of the carrier
     # frequency.  The third is the number of pairs in the non-repeating
     # sequence, and the second is the number of pairs in the repeating
@@ -112,10 +344,7 @@ def pronto_code_to_pronto_signals(pronto_code, repeat=1):
     seq2_start_index = seq1_start_index + seq1_num_pairs * 2
     seq1 = parts[seq1_start_index:seq1_start_index + seq1_num_pairs * 2]
     seq2 = parts[seq2_start_index:seq2_start_index + seq2_num_pairs * 2]
-
-    # Note that signals contain (pulse, space) pairs, but we discard the last
-    # space.
-    return carrier_frequency, (seq1 + seq2 * repeat)[:-1]
+    return carrier_frequency, seq1, seq2
 
 def pronto_signals_to_pronto_code(carrier_frequency, seq1, seq2):
     assert len(seq1) % 2 == 0 and len(seq2) % 2 == 0
@@ -127,6 +356,10 @@ def pronto_signals_to_pronto_code(carrier_frequency, seq1, seq2):
             seq1, seq2))
 
 def nec_code_to_pronto_code(device_address, key_code):
+    return pronto_signals_to_pronto_code(
+        *nec_code_to_pronto_sequences(device_address, key_code))
+
+def nec_code_to_pronto_sequences(device_address, key_code):
     # An NEC code uses a carrier frequency of 38kHz and consists of:
     # - 9ms burst pulse (342), 4ms space (152)
     # - 8-bit device address
@@ -146,15 +379,19 @@ def nec_code_to_pronto_code(device_address, key_code):
     # The data bytes are sent least significant bit first.
     seq1 = [342, 152]
     seq1.extend(nec_signal_for_byte(device_address))
-    seq1.extend(nec_signal_for_byte(~device_address & 0xf))
+    seq1.extend(nec_signal_for_byte(~device_address & 0xff))
     seq1.extend(nec_signal_for_byte(key_code))
-    seq1.extend(nec_signal_for_byte(~key_code & 0xf))
+    seq1.extend(nec_signal_for_byte(~key_code & 0xff))
     seq1.extend((22, 1520))
 
     seq2 = [342, 86, 22, 3648]
-    return pronto_signals_to_pronto_code(38000, seq1, seq2)
+    return 38000, seq1, seq2
 
 def philips_rc5_to_pronto_code(device_address, key_code):
+    return pronto_signals_to_pronto_code(
+        *philips_rc5_to_pronto_sequences(device_address, key_code))
+
+def philips_rc5_to_pronto_sequences(device_address, key_code):
     # A Philips RC5 code uses a carrier frequency of 36kHz and consists of
     # 14 bits in a row:
     # - 2 start bits, but 1's
@@ -185,7 +422,40 @@ def philips_rc5_to_pronto_code(device_address, key_code):
     else:
         seq2[-1] += 3208
 
-    return pronto_signals_to_pronto_code(36000, seq1, seq2)
+    return 36000, seq1, seq2
+
+def denon_code_to_pronto_code(device_address, key_code):
+    return pronto_signals_to_pronto_code(
+        *denon_code_to_pronto_sequences(device_address, key_code))
+
+def denon_code_to_pronto_sequences(device_address, key_code):
+    # A Denon (or Sharp) code uses a carrier frequency of 38kHz and consists
+    # of two frames of 15 bits each:
+    # - 5 bits for the device address
+    # - 8 bits for the command
+    # - 2 extension bits, 00 in the first frame and 11 in the second
+    # The second frame inverts the command bits, so the receiver can check
+    # them.  Each frame ends with a 263us (10) pulse and a 43.5ms (1655)
+    # space.
+    #
+    # A 0 bit is encoded as a 263us (10) pulse and 789us (30) space.
+    # A 1 bit is encoded as a 263us (10) pulse and 1842us (70) space.
+    # The data bits are sent least significant bit first.
+    seq2 = []
+    for command, extension in ((key_code, 0), (~key_code & 0xff, 3)):
+        value = device_address | (command << 5) | (extension << 13)
+        seq2.extend(encode_bits_as_signal(value, range(15), (10, 30), (10, 70)))
+        seq2.extend((10, 1655))
+
+    return 38000, [], seq2
+
+# These map protocol names to functions that take a device address and key
+# code and return (carrier_frequency, seq1, seq2).
+PROTOCOL_ENCODERS = {
+    "nec": nec_code_to_pronto_sequences,
+    "rc5": philips_rc5_to_pronto_sequences,
+    "denon": denon_code_to_pronto_sequences,
+}
 
 def occurrence_counts(seq):
     last_value = seq[0]
@@ -209,6 +479,177 @@ def encode_bits_as_signal(value, bit_indices, false_seq, true_seq):
         signals.extend(true_seq if (value & (1 << i)) else false_seq)
     return signals
 
+#----------------------------------------------------------------------------
+# Protocol decoding functions:
+
+# A received duration matches an expected one if it is off by no more than
+# this fraction of the expected duration, or by MIN_TOLERANCE_IN_US, whichever
+# is larger.  Receivers commonly stretch pulses and shrink spaces by around
+# 100us, which matters most for short durations.
+TOLERANCE = 0.3
+MIN_TOLERANCE_IN_US = 150
+
+CompactCode = collections.namedtuple(
+    "CompactCode", ("protocol", "device_address", "key_code"))
+
+def decode_pronto_code(pronto_code):
+    """Return the CompactCode for a pronto code, or None if it isn't in a
+    known protocol at that protocol's carrier frequency.
+    """
+    carrier_frequency, seq1, seq2 = pronto_parts_to_pronto_sequences(
+        pronto_code_to_pronto_array(pronto_code))
+    return decode_iguana_signals(
+        pronto_signals_to_iguana_signals(carrier_frequency, seq1 + seq2),
+        carrier_frequency)
+
+# A code is only decoded as a protocol if its carrier frequency is within this
+# of the protocol's, since the compact form is always sent at the protocol's
+# carrier frequency.
+CARRIER_FREQUENCY_TOLERANCE_IN_HZ = 1000
+
+def decode_iguana_signals(signals, carrier_frequency=None):
+    """Return the CompactCode for iguana signals, or None if they aren't in a
+    known protocol.  A code is only decoded if encoding it again gives the
+    same signals, within the tolerance, and if carrier_frequency is given,
+    only if it matches the protocol's carrier frequency, so the compact form
+    sends the same code.  Received signals have no known carrier frequency.
+    """
+    durations = [signal & iguanaIR.IG_PULSE_MASK for signal in signals]
+    for protocol, decoder in PROTOCOL_DECODERS.items():
+        decoded = decoder(durations)
+        if decoded is None:
+            continue
+
+        compact_code = CompactCode(protocol, *decoded)
+        protocol_carrier_frequency = PROTOCOL_ENCODERS[protocol](
+            *decoded)[0]
+        if carrier_frequency is not None and abs(
+                carrier_frequency - protocol_carrier_frequency) > (
+                    CARRIER_FREQUENCY_TOLERANCE_IN_HZ):
+            continue
+        if _compact_code_matches_durations(compact_code, durations):
+            return compact_code
+    return None
+
+def _compact_code_matches_durations(compact_code, durations):
+    carrier_frequency, seq1, seq2 = PROTOCOL_ENCODERS[compact_code.protocol](
+        compact_code.device_address, compact_code.key_code)
+    expected_durations = [
+        carrier_cycles_to_microseconds(carrier_frequency, cycles)
+        for cycles in seq1 + seq2]
+
+    # The final space of a recording depends on when the recording stopped,
+    # so it isn't compared.  A recording may also stop before the repeating
+    # sequence.
+    if len(durations) % 2 == 0:
+        durations = durations[:-1]
+    return len(durations) <= len(expected_durations) and all(
+        _duration_matches(duration, expected_duration)
+        for duration, expected_duration in zip(durations, expected_durations))
+
+def _duration_matches(duration, expected_duration):
+    return abs(duration - expected_duration) <= max(
+        expected_duration * TOLERANCE, MIN_TOLERANCE_IN_US)
+
+def _decode_pulse_distance_bits(durations, pulse, zero_space, one_space):
+    """Decode (pulse, space) pairs where the length of each space gives a
+    bit, least significant bit first.  Returns None if a duration doesn't
+    match.
+    """
+    value = 0
+    for bit_index in range(len(durations) // 2):
+        if not _duration_matches(durations[bit_index * 2], pulse):
+            return None
+
+        space = durations[bit_index * 2 + 1]
+        if _duration_matches(space, one_space):
+            value |= 1 << bit_index
+        elif not _duration_matches(space, zero_space):
+            return None
+    return value
+
+def decode_nec_durations(durations):
+    """Return (device_address, key_code) for the durations of an NEC code
+    (see nec_code_to_pronto_code), or None.
+    """
+    if (len(durations) < 67 or not _duration_matches(durations[0], 9000) or
+            not _duration_matches(durations[1], 4500) or
+            not _duration_matches(durations[66], 562)):
+        return None
+
+    value = _decode_pulse_distance_bits(durations[2:66], 562, 562, 1687)
+    if value is None:
+        return None
+
+    device_address, inverse_device_address, key_code, inverse_key_code = (
+        (value >> shift) & 0xff for shift in (0, 8, 16, 24))
+    if (inverse_device_address != ~device_address & 0xff or
+            inverse_key_code != ~key_code & 0xff):
+        return None
+    return device_address, key_code
+
+def decode_philips_rc5_durations(durations):
+    """Return (device_address, key_code) for the durations of a Philips RC5
+    code (see philips_rc5_to_pronto_code), or None.
+    """
+    # Expand the durations into the 28 half-bits of the code, 1 for pulse and
+    # 0 for space.  The first half-bit is a space that isn't sent, and when
+    # the code ends with a space it runs into the gap after it.
+    half_bits = [0]
+    for index, duration in enumerate(durations):
+        if len(half_bits) >= 28:
+            break
+
+        is_pulse = (index % 2 == 0)
+        if _duration_matches(duration, 889):
+            num_half_bits = 1
+        elif _duration_matches(duration, 1778):
+            num_half_bits = 2
+        elif not is_pulse and len(half_bits) == 27:
+            num_half_bits = 1
+        else:
+            return None
+        half_bits.extend([int(is_pulse)] * num_half_bits)
+
+    if len(half_bits) == 27:
+        half_bits.append(0)
+    if len(half_bits) != 28:
+        return None
+
+    # A 1 bit is a space followed by a pulse, and a 0 bit is the reverse.
+    bits = []
+    for first_half_bit, second_half_bit in zip(
+            half_bits[0::2], half_bits[1::2]):
+        if first_half_bit == second_half_bit:
+            return None
+        bits.append(second_half_bit)
+
+    if bits[0] != 1 or bits[1] != 1:
+        return None
+    return (int("".join(map(str, bits[3:8])), 2),
+        int("".join(map(str, bits[8:14])), 2))
+
+def decode_denon_durations(durations):
+    """Return (device_address, key_code) for the durations of a Denon code
+    (see denon_code_to_pronto_code), or None.
+    """
+    if len(durations) < 31 or not _duration_matches(durations[30], 263):
+        return None
+
+    value = _decode_pulse_distance_bits(durations[:30], 263, 789, 1842)
+    if value is None or value >> 13 != 0:
+        return None
+    return value & 0x1f, (value >> 5) & 0xff
+
+# These map protocol names to functions that take the durations, in
+# microseconds, of received or stored signals and return (device_address,
+# key_code), or None if the durations aren't in that protocol.
+PROTOCOL_DECODERS = {
+    "nec": decode_nec_durations,
+    "rc5": decode_philips_rc5_durations,
+    "denon": decode_denon_durations,
+}
+
 #----------------------------------------------------------------------------
 # Pronto/Iguana conversion functions:
 
@@ -245,190 +686,740 @@ def iguana_signals_to_pronto_signals(carrier_frequency, signals):
             carrier_frequency / 1000000.0))
         for microseconds in signals]
 
+#----------------------------------------------------------------------------
+# Array-based Pronto/Iguana conversion functions:
+#
+# These give the same results as the list-based functions above, but convert
+# whole arrays at once.  Codes only use a handful of distinct durations, so
+# each distinct value is converted once and the results are mapped across the
+# array.
+
+def pronto_code_to_iguana_payload(pronto_code, repeat=1):
+    """Convert a pronto code to (carrier_frequency, payload), where the payload
+    is the packed iguana signals, ready to be sent to the device.
+    """
+    carrier_frequency, seq1, seq2 = pronto_parts_to_pronto_sequences(
+        pronto_code_to_pronto_array(pronto_code))
+    return pronto_sequences_to_iguana_payload(
+        carrier_frequency, seq1, seq2, repeat)
+
+def pronto_sequences_to_iguana_payload(carrier_frequency, seq1, seq2,
+        repeat=1):
+    signals = (seq1 + seq2 * repeat)[:-1]
+    return (carrier_frequency,
+        pronto_array_to_iguana_array(carrier_frequency, signals).tostring())
+
+# When a button is held down, its repeating sequence is sent in chunks about
+# this long, so the device is asked to send a few times a second instead of
+# once per repetition.
+HOLD_CHUNK_DURATION_IN_S = 0.25
+
+HoldPayloads = collections.namedtuple("HoldPayloads", (
+    "carrier_frequency", "first_payload", "first_gap_in_s",
+    "repeat_payload", "repeat_gap_in_s"))
+
+def pronto_sequences_to_iguana_hold_payloads(carrier_frequency, seq1, seq2):
+    """Convert a code's sequences into the payloads used to hold a button
+    down: the first payload contains the whole code, and the repeat payload is
+    sent after it, over and over, and contains as many copies of the repeating
+    sequence as fit in HOLD_CHUNK_DURATION_IN_S.  Codes without a repeating
+    sequence repeat the whole code.
+
+    Since payloads can't end with a space, each one is paired with the length
+    of its final space, which must pass before the next payload is sent.
+    """
+    repeat_seq = seq2 if len(seq2) != 0 else seq1
+    num_repeats_per_chunk = max(1, int(
+        HOLD_CHUNK_DURATION_IN_S * carrier_frequency / sum(repeat_seq)))
+
+    def payload_and_gap(signals):
+        return (
+            pronto_array_to_iguana_array(
+                carrier_frequency, signals[:-1]).tostring(),
+            carrier_cycles_to_microseconds(
+                carrier_frequency, signals[-1]) / 1000000.0)
+
+    return HoldPayloads(carrier_frequency,
+        *(payload_and_gap(seq1 + seq2) +
+            payload_and_gap(repeat_seq * num_repeats_per_chunk)))
+
+def pronto_code_to_pronto_array(pronto_code):
+    """Parse the hexadecimal values of a pronto code into an unsigned int
+    array.
+    """
+    words = pronto_code.split()
+    if not all(len(word) == 4 for word in words):
+        return array.array("I", [int(word, 16) for word in words])
+
+    # Every value is a big-endian 16-bit number, so decode them all at once.
+    parts = array.array("H", binascii.unhexlify("".join(words)))
+    if sys.byteorder == "little":
+        parts.byteswap()
+    return array.array("I", parts)
+
+def pronto_array_to_iguana_array(carrier_frequency, signals):
+    """Convert an array of alternating pulses and spaces in carrier cycles
+    into an array of iguana signals, with the pulse bits set.
+    """
+    pulses = signals[0::2]
+    spaces = signals[1::2]
+    microseconds_for_pulses = dict(
+        (cycles, carrier_cycles_to_microseconds(carrier_frequency, cycles) |
+            iguanaIR.IG_PULSE_BIT)
+        for cycles in set(pulses))
+    microseconds_for_spaces = dict(
+        (cycles, carrier_cycles_to_microseconds(carrier_frequency, cycles))
+        for cycles in set(spaces))
+
+    iguana_signals = array.array("I", signals)
+    iguana_signals[0::2] = array.array(
+        "I", map(microseconds_for_pulses.__getitem__, pulses))
+    iguana_signals[1::2] = array.array(
+        "I", map(microseconds_for_spaces.__getitem__, spaces))
+    return iguana_signals
+
+def iguana_array_to_pronto_array(carrier_frequency, signals):
+    """Convert an array of iguana signals into an array of carrier cycles."""
+    cycles_for_signals = dict(
+        (signal, int(round((signal & iguanaIR.IG_PULSE_MASK) *
+            carrier_frequency / 1000000.0)))
+        for signal in set(signals))
+    return array.array("I", map(cycles_for_signals.__getitem__, signals))
+
 #----------------------------------------------------------------------------
 # Recording functions:
 
 def record_pronto_code():
-    carrier_frequency, iguana_signals = record_iguana_signals(
-        keep_end_space=True)
+    """Record a signal and return (pronto_code, carrier_confidence)."""
+    carrier_frequency, carrier_confidence, iguana_signals = (
+        record_iguana_signals(keep_end_space=True))
     pronto_signals = iguana_signals_to_pronto_signals(
         carrier_frequency, iguana_signals)
-    return pronto_signals_to_pronto_code(carrier_frequency, (), pronto_signals)
+    return (
+        pronto_signals_to_pronto_code(carrier_frequency, (), pronto_signals),
+        carrier_confidence)
+
+# Recording gives up if no signal is received for this long.
+RECORD_TIMEOUT_IN_S = 20
 
 def record_iguana_signals(keep_end_space=False):
+    """Record a signal and return (carrier_frequency, carrier_confidence,
+    signals).
+    """
     set_iguana_carrier_frequency(DEFAULT_CARRIER_FREQUENCY)
-    iguana_signals = receive_iguana_signals(keep_end_space=True)
-    iguana_signals = truncate_iguana_signals_at_gap(
-        iguana_signals, keep_end_space=True)
-    carrier_frequency = guess_carrier_frequency(iguana_signals)
-    return carrier_frequency, iguana_signals
-
-def truncate_iguana_signals_at_gap(signals, keep_end_space=False):
-    # Look at all the unique space values.
-    spaces = set(signals[1::2])
-
-    # Find the gap by finding first very large jump in space sizes.
-    sorted_spaces = tuple(sorted(spaces))
-    large_space = None
-    for i, space in enumerate(sorted_spaces):
-        if i == 0:
+    iguana_signals = receive_iguana_signals(
+        keep_end_space=True, timeout_in_s=RECORD_TIMEOUT_IN_S)
+    carrier_frequency, carrier_confidence = estimate_carrier_frequency(
+        iguana_signals)
+    return carrier_frequency, carrier_confidence, iguana_signals
+
+def guess_carrier_frequency(signals):
+    return estimate_carrier_frequency(signals)[0]
+
+def estimate_carrier_frequency(signals):
+    """Estimate the carrier frequency of recorded iguana signals.  Returns
+    (carrier_frequency, confidence), where the confidence is 1 if the signals
+    decode as a known protocol and they get that protocol's carrier
+    frequency, or 0 if they don't and they get DEFAULT_CARRIER_FREQUENCY.
+
+    The receiver removes the carrier, and its timing jitter, commonly 30-100us,
+    is more than a whole carrier cycle (26us at 38kHz), so the pulse lengths
+    can't tell the candidate frequencies apart.
+    """
+    compact_code = decode_iguana_signals(signals)
+    if compact_code is None:
+        return DEFAULT_CARRIER_FREQUENCY, 0.0
+
+    carrier_frequency = PROTOCOL_ENCODERS[compact_code.protocol](
+        compact_code.device_address, compact_code.key_code)[0]
+    return carrier_frequency, 1.0
+
+#----------------------------------------------------------------------------
+# Transmit queue functions:
+
+# Presses from the web API are queued and sent one at a time, in the order they
+# were queued, by a single background thread.  A press for a button that is
+# already waiting in the queue shares the waiting press instead of being queued
+# again.
+TRANSMIT_QUEUE_SIZE = 20
+TRANSMIT_TIMEOUT_IN_S = 10
+
+class TransmitRequest(object):
+    def __init__(self, key, carrier_frequency, payload):
+        # The key is (device_name, button_name, repeat).
+        self.key = key
+        self.carrier_frequency = carrier_frequency
+        self.payload = payload
+        self.finished = threading.Event()
+        self.error = None
+
+        # These are set, on the monotonic clock, when the device starts and
+        # finishes sending the signal.  Waiters can be woken late, so anything
+        # timed relative to the signal should use these instead.
+        self.send_start_time = None
+        self.send_end_time = None
+
+    def wait(self, timeout_in_s=TRANSMIT_TIMEOUT_IN_S):
+        """Wait until the signal was sent, raising an IRError if it could not
+        be sent.
+        """
+        if not self.finished.wait(timeout_in_s):
+            raise IRError("Timed out waiting to send %s %s" % self.key[:2])
+        if self.error is not None:
+            raise IRError("Could not send %s %s: %s" % (
+                self.key[0], self.key[1], self.error))
+
+_transmit_condition = threading.Condition()
+_queued_transmit_requests = collections.deque()
+_transmit_thread = None
+
+def queue_button_press(device_name, button_name, repeat=1, wait=True):
+    """Queue the signal for the given button to be sent to the given device.
+    Unlike press_button, this may be called from many threads at once.  If
+    wait is true, block until the signal was sent.
+
+    Returns the TransmitRequest.
+    """
+    key = (device_name, button_name, repeat)
+
+    # Look up the payload in this thread so the transmit thread never needs
+    # to use the database.
+    carrier_frequency, payload = get_iguana_payload_for_button(*key)
+
+    with _transmit_condition:
+        _start_transmit_thread()
+        request = _find_queued_transmit_request(key)
+        if request is None:
+            deadline = time.time() + TRANSMIT_TIMEOUT_IN_S
+            while len(_queued_transmit_requests) >= TRANSMIT_QUEUE_SIZE:
+                remaining_time = deadline - time.time()
+                if remaining_time <= 0:
+                    raise IRError("The IR transmit queue is full")
+                _transmit_condition.wait(remaining_time)
+
+            request = TransmitRequest(key, carrier_frequency, payload)
+            _queued_transmit_requests.append(request)
+            _transmit_condition.notify_all()
+
+    if wait:
+        request.wait()
+    return request
+
+def _find_queued_transmit_request(key):
+    for request in _queued_transmit_requests:
+        if request.key == key:
+            return request
+    return None
+
+def _start_transmit_thread():
+    global _transmit_thread
+    if _transmit_thread is None:
+        _transmit_thread = threading.Thread(
+            target=_run_transmit_thread, name="irsignal-transmit")
+        _transmit_thread.daemon = True
+        _transmit_thread.start()
+
+def _run_transmit_thread():
+    while True:
+        # Queued presses are sent first, and held buttons are only repeated
+        # while the queue is empty.
+        with _transmit_condition:
+            while len(_queued_transmit_requests) == 0:
+                hold = _next_button_hold_to_send()
+                if hold is not None:
+                    break
+            else:
+                hold = None
+                request = _queued_transmit_requests.popleft()
+                _transmit_condition.notify_all()
+
+        if hold is not None:
+            _send_button_hold(hold)
             continue
 
-        prev_space = sorted_spaces[i - 1]
-        if (space - prev_space) / float(prev_space) > 10:
-            large_space = space
-            break
+        try:
+            request.send_start_time = monotonic_time()
+            send_iguana_payload(request.carrier_frequency, request.payload)
+        except Exception as e:
+            traceback.print_exc()
+            request.error = e
+        finally:
+            request.send_end_time = monotonic_time()
+            request.finished.set()
 
-    if large_space is None:
-        return signals[:]
+        if request.error is None:
+            _pressed_button(*request.key[:2])
 
-    truncated_signals = []
-    for i, signal in enumerate(signals):
-        if i % 2 == 1 and signal >= large_space:
-            break
-        truncated_signals.append(signal)
+#----------------------------------------------------------------------------
+# Button hold functions:
+
+# While a button is held down, the transmit thread keeps sending its repeating
+# sequence whenever no presses are queued, until the button is released.  The
+# client must call hold_button again before HOLD_WATCHDOG_TIMEOUT_IN_S passes
+# or the hold ends by itself, so a lost release can't leave a device
+# repeating forever.  A hold always sends its whole code once, even if it is
+# released first, so a quick tap isn't lost.
+HOLD_WATCHDOG_TIMEOUT_IN_S = 1.0
+
+# Clients give each hold an id, and renewals and releases only apply to the
+# hold with their id.  Since the calls can arrive in any order, the states of
+# this many recent ids are remembered, so that renewals that arrive after the
+# release (or a hold that arrives after its release) don't start the hold
+# again.
+MAX_RECENT_HOLD_IDS = 100
+
+class ButtonHold(object):
+    def __init__(self, key, payloads, hold_id=None):
+        # The key is (device_name, button_name).
+        self.key = key
+        self.payloads = payloads
+        self.hold_id = hold_id
+        self.num_sends = 0
+        self.is_released = False
+        self.next_send_time = monotonic_time()
+        self.expiry_time = None
+        self.renew()
+
+    def renew(self):
+        self.expiry_time = monotonic_time() + HOLD_WATCHDOG_TIMEOUT_IN_S
+
+# This maps device names to their ButtonHolds.  A device has at most one
+# button held down at a time.
+_button_holds = {}
+
+# This maps recent hold ids to "held", "released", or "released_early" for
+# holds that were released before they were started.
+_hold_id_states = collections.OrderedDict()
+
+def hold_button(device_name, button_name, hold_id=None):
+    """Start holding down the given button on the given device, or keep
+    holding it if it is already held with the same hold id.  The button is
+    released by release_button, or when HOLD_WATCHDOG_TIMEOUT_IN_S passes
+    without another call to this function.  Calls for a hold id that was
+    already released are ignored.
+    """
+    # Look up the payloads in this thread so the transmit thread never needs
+    # to use the database.
+    payloads = get_iguana_hold_payloads_for_button(device_name, button_name)
+    key = (device_name, button_name)
+
+    with _transmit_condition:
+        _start_transmit_thread()
+        hold = _button_holds.get(device_name)
+        if (hold is not None and hold.key == key and
+                hold.hold_id == hold_id and not hold.is_released):
+            hold.renew()
+            return
+
+        hold_id_state = _hold_id_states.get(hold_id)
+        if hold_id_state == "released":
+            return
+
+        old_hold = _button_holds.get(device_name)
+        if (old_hold is not None and old_hold.is_released and
+                old_hold.num_sends == 0):
+            # A tap that hasn't been sent yet still gets sent once.
+            _queued_transmit_requests.append(TransmitRequest(
+                old_hold.key + (1,), old_hold.payloads.carrier_frequency,
+                old_hold.payloads.first_payload))
+
+        hold = ButtonHold(key, payloads, hold_id)
+        if hold_id_state == "released_early":
+            # The release overtook this call, so send the code just once.
+            hold.is_released = True
+        _set_hold_id_state(
+            hold_id, "released" if hold.is_released else "held")
+        _button_holds[device_name] = hold
+        _transmit_condition.notify_all()
+
+def release_button(device_name, button_name=None, hold_id=None):
+    """Stop holding down the button on the given device.  If a button name or
+    hold id is given, only stop if that is the button or hold being held.
+    """
+    with _transmit_condition:
+        if hold_id is not None:
+            _set_hold_id_state(hold_id,
+                "released_early" if hold_id not in _hold_id_states
+                    else "released")
+
+        hold = _button_holds.get(device_name)
+        if (hold is not None and button_name in (None, hold.key[1]) and
+                hold_id in (None, hold.hold_id)):
+            hold.is_released = True
+            if hold.num_sends != 0:
+                del _button_holds[device_name]
+
+def _set_hold_id_state(hold_id, state):
+    if hold_id is None:
+        return
 
-    if keep_end_space:
-        truncated_signals.append(large_space)
+    _hold_id_states.pop(hold_id, None)
+    _hold_id_states[hold_id] = state
+    while len(_hold_id_states) > MAX_RECENT_HOLD_IDS:
+        _hold_id_states.popitem(last=False)
 
-    return truncated_signals
+def _end_button_hold(hold):
+    """Remove the hold, unless it was already replaced.  This must be called
+    while holding _transmit_condition.
+    """
+    device_name = hold.key[0]
+    if _button_holds.get(device_name) is hold:
+        del _button_holds[device_name]
+
+def _next_button_hold_to_send():
+    """Return the hold that is due to be sent next, after waiting until it is
+    due, or wait for something to change and return None.  This must be
+    called while holding _transmit_condition.
+    """
+    # Holds that haven't been sent yet don't expire, so they are sent once.
+    now = monotonic_time()
+    for hold in _button_holds.values():
+        if hold.num_sends != 0 and hold.expiry_time <= now:
+            _end_button_hold(hold)
+
+    if len(_button_holds) == 0:
+        _transmit_condition.wait()
+        return None
+
+    hold = min(_button_holds.values(), key=lambda hold: hold.next_send_time)
+    if hold.next_send_time > now:
+        _transmit_condition.wait(hold.next_send_time - now)
+        return None
+    return hold
+
+def _send_button_hold(hold):
+    payloads = hold.payloads
+    if hold.num_sends == 0:
+        payload, gap_in_s = payloads.first_payload, payloads.first_gap_in_s
+    else:
+        payload, gap_in_s = payloads.repeat_payload, payloads.repeat_gap_in_s
 
-def guess_carrier_frequency(signals):
-    # TODO: This always chooses the highest frequency we look for.  So, we punt
-    #       and choose the default frequency.
-    return DEFAULT_CARRIER_FREQUENCY
-
-    # Carrier frequencies are typically 33-40 kHz or 50-60 KHz, with 38 KHz
-    # being the most common.
-    best_error = None
-    best_carrier_frequency = None
-
-    # Look at the sum of the roundoff errors when converting to cycles for
-    # various carrier frequencies.
-    for carrier_frequency in itertools.chain(
-            (38000,),
-            range(33000, 38000, 1000),
-            range(39000, 41000, 1000),
-            range(50000, 61000, 1000)):
-        error = sum(error_with_carrier_frequency(
-                carrier_frequency, signal & iguanaIR.IG_PULSE_MASK)
-            for signal in signals)
-        if best_error is None or best_error > error:
-            best_error = error
-            best_carrier_frequency = carrier_frequency
-
-    return carrier_frequency
-
-def error_with_carrier_frequency(carrier_frequency, original_microseconds):
-    cycles = int(round(original_microseconds * carrier_frequency / 1000000.0))
-    microseconds = 1000000.0 * cycles / carrier_frequency
-    return abs(original_microseconds - microseconds)
+    try:
+        send_iguana_payload(payloads.carrier_frequency, payload)
+    except Exception:
+        traceback.print_exc()
+        with _transmit_condition:
+            _end_button_hold(hold)
+        return
+
+    # The device returns once it has sent the payload, so the next payload is
+    # due once the payload's final space has passed.
+    with _transmit_condition:
+        hold.num_sends += 1
+        hold.next_send_time = monotonic_time() + gap_in_s
+        if hold.is_released:
+            _end_button_hold(hold)
+    if hold.num_sends == 1:
+        _pressed_button(*hold.key)
 
 #----------------------------------------------------------------------------
 # Iguana device functions:
 
-def mark_as_busy(is_busy):
-    config = Config.get()
-    config.busy_start_time = (timezone.now() if is_busy else None)
-    config.save()
-
 def connect_to_iguana():
-    conn = iguanaIR.connect("0")
+    conn = iguanaIR.connect(
+        getattr(settings, "IRSIGNAL_IGUANA_DEVICE", "0"))
     if not conn or conn == -1:
         raise IRError("Could not connect to the iguanaIR device")
     return conn
 
+class IguanaSession(object):
+    """A connection to the iguanaIR device that is kept open and reused
+    between operations, instead of paying for a connect and close each time.
+
+    Operations are run with run(), which serializes access to the connection,
+    checks that a connection that has sat idle is still healthy, and
+    reconnects and retries once if the operation raises an IRError before any
+    signals were written to the device.
+    """
+    # Connections that have been idle for longer than this are checked by
+    # asking the device for its version before they are reused.
+    HEALTH_CHECK_INTERVAL_IN_S = 30
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.lock_file_descriptor = None
+        self.conn = None
+        self.last_used_time = None
+
+        # Remember the carrier frequency we last set on the device so we
+        # don't set it before every send.
+        self.carrier_frequency = None
+
+    def run(self, operation, retry=True):
+        """Call operation(conn) with an open connection and return its
+        result.
+        """
+        with self.lock:
+            self._lock_device()
+            try:
+                try:
+                    return operation(self._connection())
+                except IRSendError:
+                    self.close()
+                    raise
+                except IRError:
+                    self.close()
+                    if not retry:
+                        raise
+                    return operation(self._connection())
+            finally:
+                self._unlock_device()
+
+    @contextlib.contextmanager
+    def receiving(self):
+        """Lock the device, turn on its receiver, and yield the connection.
+        The receiver stays on for the connection, and the packets it keeps
+        sending would be mistaken for responses to later requests, so the
+        connection is closed afterwards.
+        """
+        with self.lock:
+            self._lock_device()
+            try:
+                conn = self._connection()
+                send_iguana_request(
+                    conn, iguanaIR.IG_DEV_RECVON, wait_for_response=False)
+                yield conn
+            finally:
+                self.close()
+                self._unlock_device()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                iguanaIR.close(self.conn)
+            self.conn = None
+            self.carrier_frequency = None
+
+    def set_carrier_frequency(self, conn, carrier_frequency):
+        if self.carrier_frequency == carrier_frequency:
+            return
+
+        send_iguana_request(conn, iguanaIR.IG_DEV_SETCARRIER,
+            [socket.htonl(carrier_frequency)])
+        self.carrier_frequency = carrier_frequency
+
+    def _lock_device(self):
+        # Other processes (celery workers and management commands) use the
+        # device too, so also hold an exclusive lock on a file while using it.
+        # The lock file only needs to be readable for flock to work.
+        if self.lock_depth == 0:
+            if self.lock_file_descriptor is None:
+                self.lock_file_descriptor = os.open(
+                    getattr(settings, "IRSIGNAL_LOCK_FILE",
+                        os.path.join(tempfile.gettempdir(), "irsignal.lock")),
+                    os.O_RDONLY | os.O_CREAT, 0666)
+            fcntl.flock(self.lock_file_descriptor, fcntl.LOCK_EX)
+        self.lock_depth += 1
+
+    def _unlock_device(self):
+        self.lock_depth -= 1
+        if self.lock_depth == 0:
+            fcntl.flock(self.lock_file_descriptor, fcntl.LOCK_UN)
+
+    def _connection(self):
+        if (self.conn is not None and time.time() - self.last_used_time >
+                self.HEALTH_CHECK_INTERVAL_IN_S):
+            try:
+                send_iguana_request(self.conn, iguanaIR.IG_DEV_GETVERSION)
+            except IRError:
+                self.close()
+
+        if self.conn is None:
+            self.conn = connect_to_iguana()
+        self.last_used_time = time.time()
+        return self.conn
+
+_iguana_session = IguanaSession()
+
 def send_iguana_signals(carrier_frequency, signals):
     """Given a carrier frequency and signals in iguana format (as returned by
     get_iguana_signals_for_button), send them using the device.
     """
-    mark_as_busy(True)
-    try:
-        conn = connect_to_iguana()
-        set_iguana_carrier_frequency(carrier_frequency, conn)
-        send_iguana_request(conn, iguanaIR.IG_DEV_SEND,
-            [signal | command for signal, command in zip(
-                signals, itertools.cycle((iguanaIR.IG_PULSE_BIT, 0)))])
-        iguanaIR.close(conn)
-    finally:
-        mark_as_busy(False)
+    send_iguana_payload(carrier_frequency, pack_iguana_signals(signals))
 
-_last_carrier_frequency = None
-def set_iguana_carrier_frequency(carrier_frequency, conn=None):
-    global _last_carrier_frequency
-    if (_last_carrier_frequency is not None and
-            _last_carrier_frequency == carrier_frequency):
-        return
+def send_iguana_payload(carrier_frequency, payload):
+    """Given a carrier frequency and a packed payload (as returned by
+    get_iguana_payload_for_button), send it using the device.
+    """
+    def send(conn):
+        _iguana_session.set_carrier_frequency(conn, carrier_frequency)
+        send_iguana_request(conn, iguanaIR.IG_DEV_SEND, payload=payload,
+            timeout_in_ms=RESPONSE_TIMEOUT_IN_MS +
+                iguana_payload_duration_in_us(payload) // 1000)
 
-    _last_carrier_frequency = carrier_frequency
+    _iguana_session.run(send)
 
-    conn_was_none = conn is None
-    if conn is None:
-        conn = connect_to_iguana()
-    send_iguana_request(
-        conn, iguanaIR.IG_DEV_SETCARRIER, [socket.htonl(carrier_frequency)])
-    if conn_was_none:
-        iguanaIR.close(conn)
+def iguana_payload_duration_in_us(payload):
+    return sum(signal & iguanaIR.IG_PULSE_MASK
+        for signal in array.array("I", payload))
 
-def send_iguana_request(
-        conn, command_type, command_data=None, wait_for_response=True):
+def pack_iguana_signals(signals):
+    """Pack iguana signals, alternating between pulses and spaces, into the
+    binary format sent to the device.
+    """
+    iguana_signals = array.array("I", signals)
+    iguana_signals[0::2] = array.array("I",
+        [signal | iguanaIR.IG_PULSE_BIT for signal in iguana_signals[0::2]])
+    return iguana_signals.tostring()
+
+def set_iguana_carrier_frequency(carrier_frequency):
+    _iguana_session.run(lambda conn:
+        _iguana_session.set_carrier_frequency(conn, carrier_frequency))
+
+# The device responds to a request once it has carried it out, so the response
+# to a send is waited for this long plus however long the signals take to send.
+RESPONSE_TIMEOUT_IN_MS = 1000
+
+def send_iguana_request(conn, command_type, command_data=None,
+        wait_for_response=True, payload=None,
+        timeout_in_ms=RESPONSE_TIMEOUT_IN_MS):
+    """Write a request to the device and wait for its response.  Failures
+    raise an IRError, or an IRSendError if the request was an IG_DEV_SEND that
+    was written but not confirmed.
+    """
     if command_data is not None:
-        request = iguanaIR.createRequest(
-            command_type,
-            "".join(struct.pack("I", signal) for signal in command_data))
+        payload = array.array("I", command_data).tostring()
+
+    if payload is not None:
+        request = iguanaIR.createRequest(command_type, payload)
     else:
         request = iguanaIR.createRequest(command_type)
-    result = iguanaIR.writeRequest(request, conn)
+    if not iguanaIR.writeRequest(request, conn):
+        raise IRError("Could not write a request to the iguanaIR device")
 
     if wait_for_response:
-        response = iguanaIR.readResponse(conn, 1000)
-        if iguanaIR.responseIsError(response):
-            raise IRError("An error occurred while sending an IR signal")
+        response = iguanaIR.readResponse(conn, timeout_in_ms)
+        if response is None or iguanaIR.responseIsError(response):
+            error_class = (IRSendError
+                if command_type == iguanaIR.IG_DEV_SEND else IRError)
+            raise error_class("An error occurred while sending an IR signal")
+
+def receive_iguana_signals(keep_end_space=False, timeout_in_s=None):
+    """Receive the next frame (see iter_iguana_frames) and return its
+    signals.  Unless keep_end_space is true, the space after the frame is
+    removed so the signals end with a pulse.
+    """
+    frames = receive_iguana_frames(timeout_in_s)
+    try:
+        signals = next(frames)
+    finally:
+        frames.close()
 
-def receive_iguana_signals(keep_end_space=False):
-    conn = connect_to_iguana()
+    return signals if keep_end_space else signals[:-1]
 
-    # Turn on the IR receiver.
-    send_iguana_request(conn, iguanaIR.IG_DEV_RECVON, wait_for_response=False)
+def receive_iguana_frames(timeout_in_s=None):
+    """Turn on the receiver and generate the frames it receives, as they
+    arrive, until the generator is closed.  If timeout_in_s is given and that
+    long passes without a frame, raise an IRError.
 
-    # collect signals until we have a huge gap of 1 second
-    signals = []
-    current_type = 0
-    current_length = 0
+    The device stays locked while the generator is open, so close it (or
+    exhaust it with a for loop that breaks) when done.
+    """
+    with _iguana_session.receiving() as conn:
+        for frame in iter_iguana_frames(
+                _iter_iguana_packets(conn, timeout_in_s)):
+            yield frame
+
+# Packets are read with this timeout, so the end of a signal is noticed even
+# when the device stops sending packets.
+RECEIVE_POLL_INTERVAL_IN_MS = 50
+
+def _iter_iguana_packets(conn, timeout_in_s):
+    """Generate arrays of raw signals read from the device, or None when no
+    packet arrived within RECEIVE_POLL_INTERVAL_IN_MS.
+    """
+    last_packet_time = monotonic_time()
     while True:
-        packet = iguanaIR.readResponse(conn, 1000)
+        packet = iguanaIR.readResponse(conn, RECEIVE_POLL_INTERVAL_IN_MS)
         if packet is None:
-            raise IRError("No packet received in the last second")
-        data = iguanaIR.removeData(packet)
-
-        for signal in struct.unpack('I' * (len(data) / 4), data):
-            if signal & iguanaIR.IG_PULSE_BIT != current_type:
-                if current_length > iguanaIR.IG_PULSE_MASK:
-                    current_length = iguanaIR.IG_PULSE_MASK
-                signals.append(current_type | current_length)
-
-                # prepare for the next pass
-                current_type = signal & iguanaIR.IG_PULSE_BIT
-                current_length = 0
-
-            # stop when we've collected a full signal
-            current_length += signal & iguanaIR.IG_PULSE_MASK
-        if current_length > 1000000 and len(signals) != 0:
-            break
-
-    iguanaIR.close(conn)
-
-    # Make sure we start with a pulse, not a space.
-    if not (signals[0] & iguanaIR.IG_PULSE_BIT):
-        signals = signals[1:]
-
-    # Make sure we end with a pulse, not a space.
-    if not keep_end_space and len(signals) % 2 == 0:
-        signals = signals[:-1]
-    elif keep_end_space and len(signals) % 2 == 1:
-        signals.append(signals[-2])
+            if (timeout_in_s is not None and
+                    monotonic_time() - last_packet_time > timeout_in_s):
+                raise IRError(
+                    "No IR signal received in %s seconds" % timeout_in_s)
+            yield None
+            continue
 
-    return signals
+        last_packet_time = monotonic_time()
+        yield array.array("I", iguanaIR.removeData(packet))
+
+# A space at least this long ends a frame.  The spaces within frames are at
+# most a few milliseconds long, while the gaps between frames, including a
+# held button's repeat frames, are at least 20ms.
+FRAME_GAP_IN_US = 15000
+
+# A frame is yielded as soon as the space after it ends, or once the space
+# reaches this length, which is longer than the gap between any protocol's
+# repeat frames.  This is the space kept at the end of the frame.
+MAX_FRAME_GAP_IN_US = 120000
+
+# Frames with more signals than this are noise or a stuck transmitter, so they
+# are dropped instead of being buffered.
+MAX_FRAME_SIGNALS = 1024
+
+def iter_iguana_frames(packets):
+    """Given an iterable of raw signal arrays from the device, where None
+    means RECEIVE_POLL_INTERVAL_IN_MS passed without a packet, generate each
+    frame as soon as it ends.
+
+    The device reports pulses and spaces in pieces, so consecutive pieces of
+    the same type are merged.  A frame is an array of alternating pulses
+    (with the pulse bit set) and spaces in microseconds that starts with a
+    pulse and ends with the space that followed it.  Polls without a packet
+    only count towards ending a frame that went quiet; they aren't added to
+    the frame, since a late packet may still continue it.
+    """
+    frame = array.array("I")
+    is_overflowing = False
+    is_pulse = False
+    length = 0
+    silence_in_us = 0
+
+    for packet in packets:
+        for signal in (packet if packet is not None else (None,)):
+            if signal is None:
+                silence_in_us += RECEIVE_POLL_INTERVAL_IN_MS * 1000
+            else:
+                silence_in_us = 0
+                signal_is_pulse = (signal & iguanaIR.IG_PULSE_BIT) != 0
+                if signal_is_pulse != is_pulse:
+                    # The current run ended.  Spaces before a frame's first
+                    # pulse aren't part of it.
+                    if is_pulse or len(frame) != 0:
+                        frame.append(
+                            (iguanaIR.IG_PULSE_BIT if is_pulse else 0) |
+                            min(length, iguanaIR.IG_PULSE_MASK))
+                        if len(frame) > MAX_FRAME_SIGNALS:
+                            is_overflowing = True
+                            del frame[:]
+
+                    if signal_is_pulse and len(frame) != 0 and (
+                            frame[-1] >= FRAME_GAP_IN_US):
+                        if not is_overflowing:
+                            yield frame
+                        frame = array.array("I")
+                        is_overflowing = False
+
+                    is_pulse = signal_is_pulse
+                    length = 0
+
+                length += signal & iguanaIR.IG_PULSE_MASK
+
+            # Don't wait for the next pulse to end a frame that went quiet,
+            # whether the device reported the space or just stopped sending.
+            quiet_time_in_us = silence_in_us + (0 if is_pulse else length)
+            if quiet_time_in_us >= MAX_FRAME_GAP_IN_US and (
+                    len(frame) != 0 or is_pulse or is_overflowing):
+                if is_pulse:
+                    frame.append(iguanaIR.IG_PULSE_BIT |
+                        min(length, iguanaIR.IG_PULSE_MASK))
+                frame.append(MAX_FRAME_GAP_IN_US)
+                if not is_overflowing and len(frame) <= MAX_FRAME_SIGNALS:
+                    yield frame
+                frame = array.array("I")
+                is_overflowing = False
+                is_pulse = False
+                length = 0
 
 def exit_with_usage():
     usage = (
@@ -1,3 +1,494 @@
+import os
+import imp
+import time
+import random
+import threading
+
 from django.test import TestCase
 
-# Create your tests here.
+from irsignal import models
+
+# The fixtures directory isn't a package, so load the fixture by its path.
+initial_data = imp.load_source("irsignal_initial_data", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "initial_data.py"))
+
+def get_fixture_pronto_codes(device_names=None):
+    """Return the pronto codes that the initial data fixture adds, for all
+    devices or only the given ones.
+    """
+    pronto_codes = []
+    def add_code_if_missing(device, button, pronto_code):
+        if device_names is None or device in device_names:
+            pronto_codes.append(pronto_code)
+
+    original_add_code_if_missing = initial_data.add_code_if_missing
+    initial_data.add_code_if_missing = add_code_if_missing
+    try:
+        initial_data.add_buttons()
+    finally:
+        initial_data.add_code_if_missing = original_add_code_if_missing
+    return pronto_codes
+
+class ArrayConversionTest(TestCase):
+    """Check that the array-based conversion functions give the same results
+    as the list-based ones.
+    """
+    def setUp(self):
+        self.pronto_codes = get_fixture_pronto_codes() + [
+            models.nec_code_to_pronto_code(0x04, 0x08),
+            models.philips_rc5_to_pronto_code(5, 12),
+        ]
+
+        # Make some codes with random durations, so values that aren't in the
+        # fixtures are covered too.
+        rng = random.Random(0)
+        for num_pairs in (1, 2, 17, 100):
+            self.pronto_codes.append(" ".join(
+                "%04X" % value for value in
+                [0, rng.choice((0x6d, 0x68, 0x73)), num_pairs, 0] +
+                [rng.randint(1, 0xffff) for i in range(num_pairs * 2)]))
+
+    def test_fixtures_were_found(self):
+        self.assertTrue(len(get_fixture_pronto_codes()) > 0)
+
+    def test_pronto_code_to_iguana_payload(self):
+        for pronto_code in self.pronto_codes:
+            for repeat in (1, 2, 5):
+                self.assertEqual(
+                    models.pronto_code_to_iguana_payload(pronto_code, repeat),
+                    self.list_based_iguana_payload(pronto_code, repeat))
+
+    def test_pronto_array_to_iguana_array(self):
+        for pronto_code in self.pronto_codes:
+            carrier_frequency, signals = models.pronto_code_to_pronto_signals(
+                pronto_code)
+            self.assertEqual(
+                list(models.pronto_array_to_iguana_array(
+                    carrier_frequency, signals)),
+                models.pronto_signals_to_iguana_signals(
+                    carrier_frequency, signals))
+
+    def test_iguana_array_to_pronto_array(self):
+        for pronto_code in self.pronto_codes:
+            carrier_frequency, iguana_signals = (
+                models.pronto_code_to_iguana_signals(pronto_code, 1))
+            self.assertEqual(
+                list(models.iguana_array_to_pronto_array(
+                    carrier_frequency, iguana_signals)),
+                models.iguana_signals_to_pronto_signals(
+                    carrier_frequency, iguana_signals))
+
+    def test_words_that_are_not_four_characters(self):
+        # Codes with leading zeros dropped or extra ones added can't be decoded
+        # all at once, so they take a slower path that must agree.
+        for pronto_code in self.pronto_codes:
+            for word_format in ("%X", "%05X", "%x"):
+                reformatted_code = " ".join(
+                    word_format % int(word, 16)
+                    for word in pronto_code.split())
+                self.assertEqual(
+                    list(models.pronto_code_to_pronto_array(
+                        reformatted_code)),
+                    [int(word, 16) for word in pronto_code.split()])
+                self.assertEqual(
+                    models.pronto_code_to_iguana_payload(reformatted_code),
+                    self.list_based_iguana_payload(pronto_code, 1))
+
+    def list_based_iguana_payload(self, pronto_code, repeat):
+        carrier_frequency, signals = models.pronto_code_to_iguana_signals(
+            pronto_code, repeat)
+        return (carrier_frequency, models.pack_iguana_signals(signals))
+
+class ButtonHoldTest(TestCase):
+    """Check that holds and releases for a press work whatever order they
+    arrive in, without sending the device any real signals.
+    """
+    def setUp(self):
+        self.sent_payloads = []
+        self.send_lock = threading.Lock()
+        self.original_functions = dict(
+            (name, getattr(models, name)) for name in (
+                "send_iguana_payload", "get_iguana_hold_payloads_for_button"))
+
+        def send_iguana_payload(carrier_frequency, payload):
+            with self.send_lock:
+                self.sent_payloads.append(payload)
+
+        models.send_iguana_payload = send_iguana_payload
+        models.get_iguana_hold_payloads_for_button = (
+            lambda device_name, button_name: models.HoldPayloads(
+                38000, "first", 0.01, "repeat", 0.01))
+
+    def tearDown(self):
+        for device_name in list(models._button_holds):
+            models.release_button(device_name)
+        for name, function in self.original_functions.items():
+            setattr(models, name, function)
+
+    def wait_until_idle(self):
+        deadline = time.time() + 2
+        while len(models._button_holds) != 0 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+
+    def test_hold_repeats_until_released(self):
+        models.hold_button("tv", "volume_up", "press-1")
+        time.sleep(0.2)
+        models.release_button("tv", "volume_up", "press-1")
+        self.wait_until_idle()
+        self.assertEqual(self.sent_payloads[0], "first")
+        self.assertTrue(len(self.sent_payloads) > 2)
+        self.assertEqual(set(self.sent_payloads[1:]), set(["repeat"]))
+
+    def test_renewals_after_the_release_are_ignored(self):
+        models.hold_button("tv", "volume_up", "press-2")
+        models.release_button("tv", "volume_up", "press-2")
+        models.hold_button("tv", "volume_up", "press-2")
+        self.wait_until_idle()
+        self.assertEqual(self.sent_payloads, ["first"])
+
+    def test_release_before_hold_sends_the_code_once(self):
+        models.release_button("tv", "volume_up", "press-3")
+        models.hold_button("tv", "volume_up", "press-3")
+        models.hold_button("tv", "volume_up", "press-3")
+        self.wait_until_idle()
+        self.assertEqual(self.sent_payloads, ["first"])
+
+    def test_release_before_the_first_send_still_sends_the_code(self):
+        # Keep the transmit thread busy, as a queued press would.
+        self.send_lock.acquire()
+        try:
+            models.hold_button("tv", "volume_up", "press-4")
+            time.sleep(0.05)
+            models.release_button("tv", "volume_up", "press-4")
+        finally:
+            self.send_lock.release()
+        self.wait_until_idle()
+        self.assertEqual(self.sent_payloads, ["first"])
+
+class FrameTest(TestCase):
+    """Check that iter_iguana_frames reassembles frames from packets however
+    the device splits them up.
+    """
+    def setUp(self):
+        carrier_frequency, seq1, seq2 = models.nec_code_to_pronto_sequences(
+            0x12, 0x34)
+        self.signals = models.pronto_signals_to_iguana_signals(
+            carrier_frequency, seq1)
+        self.pulse_bit = models.iguanaIR.IG_PULSE_BIT
+
+    def packets_for_signals(self, signals, rng):
+        """Split the signals into packets at random points, sometimes also
+        splitting one signal into two pieces.
+        """
+        pieces = []
+        for signal in signals:
+            duration = signal & models.iguanaIR.IG_PULSE_MASK
+            if duration > 1 and rng.random() < 0.3:
+                first_duration = rng.randint(1, duration - 1)
+                pieces.append(first_duration | (signal & self.pulse_bit))
+                pieces.append(
+                    (duration - first_duration) | (signal & self.pulse_bit))
+            else:
+                pieces.append(signal)
+
+        packets = []
+        while len(pieces) != 0:
+            num_pieces = rng.randint(1, 8)
+            packets.append(pieces[:num_pieces])
+            pieces = pieces[num_pieces:]
+        return packets
+
+    def expected_frame(self):
+        return self.signals[:-1] + [models.MAX_FRAME_GAP_IN_US]
+
+    def test_split_packets(self):
+        rng = random.Random(1)
+        for i in range(20):
+            packets = self.packets_for_signals(self.signals[:-1], rng)
+            frames = list(models.iter_iguana_frames(
+                packets + [None] * 3))
+            self.assertEqual([list(frame) for frame in frames],
+                [self.expected_frame()])
+
+    def test_stalled_polls_dont_split_frames(self):
+        rng = random.Random(2)
+        max_stalled_polls = (models.MAX_FRAME_GAP_IN_US //
+            (models.RECEIVE_POLL_INTERVAL_IN_MS * 1000))
+        for i in range(20):
+            packets = []
+            for packet in self.packets_for_signals(self.signals[:-1], rng):
+                packets.append(packet)
+                packets.extend([None] * rng.randint(0, max_stalled_polls))
+            frames = list(models.iter_iguana_frames(
+                packets + [None] * 3))
+            self.assertEqual([list(frame) for frame in frames],
+                [self.expected_frame()])
+            self.assertEqual(
+                models.decode_iguana_signals(frames[0]),
+                models.CompactCode("nec", 0x12, 0x34))
+
+    def test_frames_separated_by_gaps(self):
+        gap = models.FRAME_GAP_IN_US * 2
+        signals = self.signals[:-1] + [gap] + self.signals[:-1]
+        frames = list(models.iter_iguana_frames([signals, None, None, None]))
+        self.assertEqual([list(frame) for frame in frames],
+            [self.signals[:-1] + [gap], self.expected_frame()])
+
+    def test_silence_during_a_pulse_ends_the_frame(self):
+        signals = self.signals[:3]
+        frames = list(models.iter_iguana_frames([signals, None, None, None]))
+        self.assertEqual([list(frame) for frame in frames],
+            [signals + [models.MAX_FRAME_GAP_IN_US]])
+
+class DecoderTest(TestCase):
+    """Check that codes in known protocols decode, and that codes that the
+    compact form can't reproduce don't.
+    """
+    def encoded_pronto_code(self, protocol, device_address, key_code):
+        return models.pronto_signals_to_pronto_code(
+            *models.PROTOCOL_ENCODERS[protocol](device_address, key_code))
+
+    def test_encoded_codes_round_trip(self):
+        rng = random.Random(3)
+        for protocol, max_device_address, max_key_code in (
+                ("nec", 255, 255), ("rc5", 31, 63), ("denon", 31, 255)):
+            for i in range(50):
+                compact_code = models.CompactCode(protocol,
+                    rng.randint(0, max_device_address),
+                    rng.randint(0, max_key_code))
+                self.assertEqual(
+                    models.decode_pronto_code(
+                        self.encoded_pronto_code(*compact_code)),
+                    compact_code)
+
+    def test_received_signals_decode(self):
+        for compact_code in (models.CompactCode("nec", 0x12, 0x34),
+                models.CompactCode("rc5", 5, 12),
+                models.CompactCode("denon", 2, 225)):
+            carrier_frequency, seq1, seq2 = models.PROTOCOL_ENCODERS[
+                compact_code.protocol](*compact_code[1:])
+            signals = models.pronto_signals_to_iguana_signals(
+                carrier_frequency, seq1 + seq2)
+            self.assertEqual(
+                models.decode_iguana_signals(signals), compact_code)
+
+    def test_denon_fixtures_round_trip(self):
+        denon_codes = get_fixture_pronto_codes(["denon-avr3806"])
+        self.assertEqual(len(denon_codes), 7)
+        for pronto_code in denon_codes:
+            compact_code = models.decode_pronto_code(pronto_code)
+            self.assertEqual(compact_code.protocol, "denon")
+            self.assertEqual(
+                models.decode_pronto_code(
+                    self.encoded_pronto_code(*compact_code)),
+                compact_code)
+
+    def test_other_fixtures_stay_raw(self):
+        pronto_codes = get_fixture_pronto_codes(
+            ["elitescreens", "optoma-hd141x"])
+        self.assertEqual(len(pronto_codes), 5)
+        for pronto_code in pronto_codes:
+            self.assertEqual(models.decode_pronto_code(pronto_code), None)
+
+    def test_toggled_rc5_code_stays_raw(self):
+        # The compact form always sends a toggle bit of 0.
+        pulses = [1, 0, 1, 0, 1]
+        pulses.extend(models.encode_bits_as_signal(
+            5, range(4, -1, -1), (1, 0), (0, 1)))
+        pulses.extend(models.encode_bits_as_signal(
+            12, range(5, -1, -1), (1, 0), (0, 1)))
+        seq2 = [count * 32 for count in models.occurrence_counts(pulses)]
+        if len(seq2) % 2 == 1:
+            seq2.append(3208)
+        else:
+            seq2[-1] += 3208
+        self.assertEqual(models.decode_pronto_code(
+            models.pronto_signals_to_pronto_code(36000, [], seq2)), None)
+
+    def test_extended_nec_code_stays_raw(self):
+        # Extended NEC codes use a 16-bit address instead of an address and
+        # its inverse.
+        seq1 = [342, 152]
+        for byte in (0x12, 0x35, 0x34, ~0x34 & 0xff):
+            seq1.extend(models.nec_signal_for_byte(byte))
+        seq1.extend((22, 1520))
+        self.assertEqual(models.decode_pronto_code(
+            models.pronto_signals_to_pronto_code(
+                38000, seq1, [342, 86, 22, 3648])), None)
+
+    def test_code_at_another_carrier_frequency_stays_raw(self):
+        # Keep the NEC timing, but at 36kHz instead of 38kHz.
+        carrier_frequency, seq1, seq2 = models.nec_code_to_pronto_sequences(
+            0x12, 0x34)
+        seq1, seq2 = [
+            [int(round(cycles * 36000.0 / carrier_frequency))
+                for cycles in seq]
+            for seq in (seq1, seq2)]
+        pronto_code = models.pronto_signals_to_pronto_code(36000, seq1, seq2)
+        self.assertEqual(models.decode_pronto_code(pronto_code), None)
+
+        # Received signals have no carrier frequency to compare.
+        self.assertEqual(
+            models.decode_iguana_signals(
+                models.pronto_signals_to_iguana_signals(36000, seq1 + seq2)),
+            models.CompactCode("nec", 0x12, 0x34))
+
+class CarrierFrequencyTest(TestCase):
+    """Check estimate_carrier_frequency on synthetic recordings, made by
+    converting codes to microseconds at a carrier frequency and adding
+    receiver jitter.
+    """
+    def recording(self, pronto_signals, carrier_frequency, jitter_in_us, rng):
+        return [
+            max(1, int(round(signal * 1000000.0 / carrier_frequency +
+                rng.gauss(0, jitter_in_us))))
+            for signal in pronto_signals]
+
+    def encoded_signals(self, protocol, device_address, key_code):
+        carrier_frequency, seq1, seq2 = models.PROTOCOL_ENCODERS[protocol](
+            device_address, key_code)
+        return seq1 + seq2
+
+    def raw_signals(self, device_name):
+        return [models.pronto_code_to_pronto_signals(pronto_code)[1] + [1000]
+            for pronto_code in get_fixture_pronto_codes([device_name])]
+
+    def test_protocol_codes_get_the_protocol_carrier_frequency(self):
+        rng = random.Random(4)
+        for protocol, carrier_frequency in (
+                ("rc5", 36000), ("nec", 38000), ("denon", 38000)):
+            for jitter_in_us in (0, 30, 60):
+                signals = self.recording(
+                    self.encoded_signals(protocol, 5, 12), carrier_frequency,
+                    jitter_in_us, rng)
+                self.assertEqual(
+                    models.estimate_carrier_frequency(signals),
+                    (carrier_frequency, 1.0))
+
+    def test_other_codes_get_the_default_carrier_frequency(self):
+        rng = random.Random(5)
+        for carrier_frequency in (36000, 38000, 56000):
+            for pronto_signals in (self.raw_signals("elitescreens") +
+                    self.raw_signals("optoma-hd141x")):
+                for jitter_in_us in (0, 60):
+                    signals = self.recording(pronto_signals,
+                        carrier_frequency, jitter_in_us, rng)
+                    self.assertEqual(
+                        models.estimate_carrier_frequency(signals),
+                        (models.DEFAULT_CARRIER_FREQUENCY, 0.0))
+
+class FakeIguanaDevice(object):
+    """Stands in for the iguanaIR module's connection functions, recording
+    the requests written and failing the ones it is told to.
+    """
+    def __init__(self):
+        self.num_connects = 0
+        self.num_connect_failures = 0
+        self.failing_command_types = []
+        self.written_command_types = []
+        self.response_timeouts = []
+
+    def connect(self, device):
+        self.num_connects += 1
+        if self.num_connect_failures != 0:
+            self.num_connect_failures -= 1
+            return -1
+        return self.num_connects
+
+    def close(self, conn):
+        pass
+
+    def createRequest(self, command_type, payload=None):
+        return command_type
+
+    def writeRequest(self, request, conn):
+        self.written_command_types.append(request)
+        return True
+
+    def readResponse(self, conn, timeout_in_ms):
+        self.response_timeouts.append(timeout_in_ms)
+        command_type = self.written_command_types[-1]
+        if command_type in self.failing_command_types:
+            # Each listed failure happens once.
+            self.failing_command_types.remove(command_type)
+            return None
+        return "response"
+
+    def responseIsError(self, response):
+        return False
+
+class IguanaSessionTest(TestCase):
+    FAKE_FUNCTION_NAMES = ("connect", "close", "createRequest", "writeRequest",
+        "readResponse", "responseIsError")
+
+    def setUp(self):
+        self.device = FakeIguanaDevice()
+        self.original_functions = dict(
+            (name, getattr(models.iguanaIR, name))
+            for name in self.FAKE_FUNCTION_NAMES)
+        for name in self.FAKE_FUNCTION_NAMES:
+            setattr(models.iguanaIR, name, getattr(self.device, name))
+
+        self.original_session = models._iguana_session
+        models._iguana_session = models.IguanaSession()
+        self.payload = models.pack_iguana_signals([9000, 4500, 560])
+
+    def tearDown(self):
+        models._iguana_session.close()
+        models._iguana_session = self.original_session
+        for name, function in self.original_functions.items():
+            setattr(models.iguanaIR, name, function)
+
+    def sends(self):
+        return self.device.written_command_types.count(
+            models.iguanaIR.IG_DEV_SEND)
+
+    def test_connection_is_reused(self):
+        models.send_iguana_payload(38000, self.payload)
+        models.send_iguana_payload(38000, self.payload)
+        self.assertEqual(self.device.num_connects, 1)
+        self.assertEqual(self.sends(), 2)
+
+        # The carrier frequency is only set when it changes.
+        self.assertEqual(self.device.written_command_types.count(
+            models.iguanaIR.IG_DEV_SETCARRIER), 1)
+
+    def test_idle_connection_is_checked_and_replaced(self):
+        models.send_iguana_payload(38000, self.payload)
+        models._iguana_session.last_used_time -= (
+            models.IguanaSession.HEALTH_CHECK_INTERVAL_IN_S + 1)
+        self.device.failing_command_types.append(
+            models.iguanaIR.IG_DEV_GETVERSION)
+        models.send_iguana_payload(38000, self.payload)
+        self.assertEqual(self.device.num_connects, 2)
+        self.assertEqual(self.sends(), 2)
+
+    def test_connect_failure_is_retried(self):
+        self.device.num_connect_failures = 1
+        models.send_iguana_payload(38000, self.payload)
+        self.assertEqual(self.device.num_connects, 2)
+        self.assertEqual(self.sends(), 1)
+
+    def test_failed_carrier_set_is_retried(self):
+        self.device.failing_command_types.append(
+            models.iguanaIR.IG_DEV_SETCARRIER)
+        models.send_iguana_payload(38000, self.payload)
+        self.assertEqual(self.sends(), 1)
+
+    def test_unconfirmed_send_is_not_resent(self):
+        # Sending a power toggle code twice would cancel it out.
+        self.device.failing_command_types.append(models.iguanaIR.IG_DEV_SEND)
+        self.assertRaises(models.IRSendError,
+            models.send_iguana_payload, 38000, self.payload)
+        self.assertEqual(self.sends(), 1)
+
+        # The next send reconnects.
+        models.send_iguana_payload(38000, self.payload)
+        self.assertEqual(self.device.num_connects, 2)
+        self.assertEqual(self.sends(), 2)
+
+    def test_send_timeout_covers_the_signals(self):
+        models.send_iguana_payload(38000, self.payload)
+        self.assertEqual(self.device.response_timeouts[-1],
+            models.RESPONSE_TIMEOUT_IN_MS + 14)
@@ -1,23 +1,94 @@
 import json
 import traceback
 import inspect
+import threading
+import time
+import datetime
+import types
+import collections
 
+from django import db
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse
+from django.db.models import Model
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
 
-# This decorator is used to flag API methods.
+# This decorator is used to flag API methods.  The method's argument names are
+# looked up once, here, instead of on every call.
 def api_method(method):
-    if inspect.getargspec(method).args[:2] != ["self", "request"]:
+    arg_names = inspect.getargspec(method).args
+    if arg_names[:2] != ["self", "request"]:
         raise RuntimeError(
             "%s's first two arguments should be self and request" %
                 method.__name__)
     method._is_api_method = True
+    method._api_method_spec = APIMethodSpec(method.__name__, arg_names[2:])
     return method
 
+# A batch of calls is run in at most this many threads, however many calls it
+# contains.
+MAX_BATCH_THREADS = 4
+
+# This decorator puts an API method in a named group.  When a batch of calls
+# is dispatched, calls to methods in the same group run one after the other, in
+# the order they were given, while all other calls run concurrently.
+def serialize_calls(group_name):
+    def decorator(method):
+        method._serialization_group = group_name
+        return method
+    return decorator
+
+class APIMethodSpec(object):
+    """
+    The precomputed argument names of an API method (excluding self and
+    request), used to validate the arguments of calls to it.
+    """
+    def __init__(self, name, arg_names):
+        self.name = name
+        self.arg_names = tuple(arg_names)
+        self.arg_name_set = frozenset(arg_names)
+        self.serialization_group = None
+
+    def validate_arguments(self, args, kwargs):
+        # Most calls pass only keyword arguments, and pass all of them.
+        if (len(args) == 0 and len(kwargs) == len(self.arg_names) and
+                self.arg_name_set.issuperset(kwargs)):
+            return
+
+        _validate_arguments(self.name, self.arg_names, args, kwargs)
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "arg_names": self.arg_names,
+            "serialization_group": self.serialization_group,
+        }
+
+class _APIMetaclass(type):
+    """
+    Build a registry of each API class's methods, mapping their names to
+    their APIMethodSpecs, when the class is created.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(_APIMetaclass, cls).__init__(name, bases, attrs)
+        cls._api_method_specs = {}
+        for base in reversed(cls.__mro__):
+            for attr_name, value in vars(base).items():
+                spec = getattr(value, "_api_method_spec", None)
+                if spec is None:
+                    cls._api_method_specs.pop(attr_name, None)
+                    continue
+
+                spec.serialization_group = getattr(
+                    value, "_serialization_group", None)
+                cls._api_method_specs[attr_name] = spec
+
 class API(object):
     """
     Handle web API requests.
     """
+    __metaclass__ = _APIMetaclass
+
     def dispatch(self, request):
         """
         Dispatch requests for '/api' URLs by:
@@ -65,79 +136,207 @@ class API(object):
             return _text_http_response(
                 "'json' not given in the POST data", 500)
 
+        # A batch of calls is a list of [function_name, args, kwargs] lists.
+        call = json.loads(json_data)
+        if len(call) != 0 and isinstance(call[0], list):
+            return self._dispatch_batch(request, call)
+
+        function_name, args, kwargs = call
+        return self._call(request, function_name, args, kwargs)
+
+    def _call(self, request, function_name, args, kwargs):
+        spec = self._api_method_spec(function_name)
+        spec.validate_arguments(args, kwargs)
+        return getattr(self, function_name)(request, *args, **kwargs)
+
+    def _api_method_spec(self, function_name):
         # Look up the API method, making sure that it exists and has been
         # flagged as an API method.
-        function_name, args, kwargs = json.loads(json_data)
-        handler = getattr(self, function_name, None)
-        if handler is None or not hasattr(handler, "_is_api_method"):
+        spec = self._api_method_specs.get(function_name)
+        if spec is None:
             raise PermissionDenied("Invalid API function: %s" % function_name)
+        return spec
 
-        self._validate_arguments(
-            function_name, inspect.getargspec(handler).args[2:], args, kwargs)
-        return handler(request, *args, **kwargs)
+    def _dispatch_batch(self, request, calls):
+        """
+        Run a batch of calls and return a list with the result of each one.
+        Calls to methods in the same serialization group run in order, and
+        other calls run concurrently, in at most MAX_BATCH_THREADS threads.  A
+        failing call doesn't stop the others; its result holds the error
+        instead.
+        """
+        results = [None] * len(calls)
+        call_indices_for_groups = {}
+        for call_index, (function_name, args, kwargs) in enumerate(calls):
+            spec = self._api_method_specs.get(function_name)
+            group_name = (spec.serialization_group
+                if spec is not None else None)
+            if group_name is None:
+                group_name = call_index
+            call_indices_for_groups.setdefault(group_name, []).append(
+                call_index)
 
-    def _validate_arguments(
-            self, function_name, expected_arg_names, args, kwargs):
-        if len(args) > len(expected_arg_names):
-            raise RuntimeError(
-                "%s received %s arguments, but only expects %s" % (
-                    function_name, len(args) + len(kwargs),
-                    len(expected_arg_names)))
+        # Each thread takes the next group's calls until none are left.
+        groups = collections.deque(call_indices_for_groups.values())
 
-        expected_kwarg_names = expected_arg_names[len(args):]
+        def run_groups():
+            try:
+                while True:
+                    try:
+                        call_indices = groups.popleft()
+                    except IndexError:
+                        return
+                    for call_index in call_indices:
+                        results[call_index] = self._batch_call_result(
+                            request, *calls[call_index])
+            finally:
+                db.connection.close()
 
-        missing_arg_names = []
-        for name in expected_kwarg_names:
-            if name not in kwargs:
-                missing_arg_names.append(name)
+        threads = [threading.Thread(target=run_groups)
+            for i in range(min(len(groups), MAX_BATCH_THREADS))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        extra_arg_names = []
-        for name in kwargs.keys():
-            if name not in expected_kwarg_names:
-                extra_arg_names.append(name)
+        return results
 
-        if len(missing_arg_names) + len(extra_arg_names) == 0:
-            return
+    def _batch_call_result(self, request, function_name, args, kwargs):
+        start_time = time.time()
+        result = None
+        error = None
+        status = 200
+        try:
+            result = self._call(request, function_name, args, kwargs)
+        except PermissionDenied:
+            error = traceback.format_exc()
+            status = 403
+        except Exception:
+            error = traceback.format_exc()
+            status = 500
+
+        if isinstance(result, HttpResponse):
+            status = result.status_code
+            result = result.content
+
+        return {
+            "result": result,
+            "error": error,
+            "status": status,
+            "duration_in_ms": int(round((time.time() - start_time) * 1000)),
+        }
+
+    @api_method
+    def list_api_methods(self, request):
+        return [spec.to_json() for name, spec in sorted(
+            self._api_method_specs.items())]
+
+def _validate_arguments(function_name, expected_arg_names, args, kwargs):
+    if len(args) > len(expected_arg_names):
+        raise RuntimeError(
+            "%s received %s arguments, but only expects %s" % (
+                function_name, len(args) + len(kwargs),
+                len(expected_arg_names)))
 
-        errors = ""
-        if len(missing_arg_names) > 0:
-            errors += "Missing keyword argument%s %s" % (
-                "s" * (len(missing_arg_names) > 0),
-                ", ".join(repr(name) for name in missing_arg_names))
+    expected_kwarg_names = expected_arg_names[len(args):]
 
-        if len(extra_arg_names) > 0:
-            errors += "Unknown keyword argument%s %s" % (
-                "s" * (len(extra_arg_names) > 0),
-                ", ".join(repr(name) for name in extra_arg_names))
+    missing_arg_names = []
+    for name in expected_kwarg_names:
+        if name not in kwargs:
+            missing_arg_names.append(name)
 
-        errors += " in call to %s" % function_name
-        raise RuntimeError(errors)
+    extra_arg_names = []
+    for name in kwargs.keys():
+        if name not in expected_kwarg_names:
+            extra_arg_names.append(name)
+
+    if len(missing_arg_names) + len(extra_arg_names) == 0:
+        return
+
+    errors = ""
+    if len(missing_arg_names) > 0:
+        errors += "Missing keyword argument%s %s" % (
+            "s" * (len(missing_arg_names) > 0),
+            ", ".join(repr(name) for name in missing_arg_names))
+
+    if len(extra_arg_names) > 0:
+        errors += "Unknown keyword argument%s %s" % (
+            "s" * (len(extra_arg_names) > 0),
+            ", ".join(repr(name) for name in extra_arg_names))
+
+    errors += " in call to %s" % function_name
+    raise RuntimeError(errors)
 
 def _json_http_response(content, status=200):
     """
-    Translate a response JSON and return.
+    Translate a response JSON and return.  Querysets and generators are
+    streamed one item at a time instead of being built up in memory first.
     """
-    return _text_http_response(json.dumps(
-        _values_to_json(content)), status=status)
+    if isinstance(content, (QuerySet, types.GeneratorType)):
+        return StreamingHttpResponse(
+            _iter_json_list(content), status=status,
+            content_type="application/json")
+
+    return _text_http_response(
+        _json_encoder.encode(content), status=status,
+        content_type="application/json")
 
-def _text_http_response(content, status=200):
+def _text_http_response(content, status=200, content_type=None):
     """
     Translate a response into HTML text.
     """
-    response = HttpResponse(content, status=status)
-    response["Content-Length"] = str(len(response.content))
+    if isinstance(content, unicode):
+        content = content.encode("utf-8")
+    response = HttpResponse(content, status=status, content_type=content_type)
+    response["Content-Length"] = str(len(content))
     return response
 
-def _values_to_json(data):
-    if isinstance(data, list):
-        return [_values_to_json(item) for item in data]
+def _iter_json_list(values):
+    if isinstance(values, QuerySet):
+        values = values.iterator()
 
-    if isinstance(data, tuple):
-        return tuple(_values_to_json(item) for item in data)
+    yield "["
+    for index, value in enumerate(values):
+        yield ("," if index != 0 else "") + _json_encoder.encode(value)
+    yield "]"
+
+#----------------------------------------------------------------------------
+# JSON encoding:
+
+# These are (type, adapter) pairs.  When a value that isn't natively supported
+# by JSON is encoded, the first adapter whose type matches converts it into
+# something that is.
+_json_adapters = []
+
+def register_json_adapter(value_type, adapter):
+    """
+    Let API methods return instances of value_type, by encoding them as JSON
+    using the result of adapter(instance).
+    """
+    _json_adapters.insert(0, (value_type, adapter))
+
+class _JSONEncoder(json.JSONEncoder):
+    def default(self, value):
+        for value_type, adapter in _json_adapters:
+            if isinstance(value, value_type):
+                return adapter(value)
+        return super(_JSONEncoder, self).default(value)
+
+_json_encoder = _JSONEncoder()
+
+def encode_json(value):
+    """
+    Encode a value as JSON the same way API method results are encoded.
+    """
+    return _json_encoder.encode(value)
 
-    if isinstance(data, dict):
-        return dict(
-            (_values_to_json(key), _values_to_json(value))
-            for key, value in data.items())
+def _model_to_json(instance):
+    return dict(
+        (field.attname, field.value_from_object(instance))
+        for field in instance._meta.concrete_fields)
 
-    return data
+register_json_adapter(
+    (datetime.datetime, datetime.date, datetime.time),
+    lambda value: value.isoformat())
+register_json_adapter(Model, _model_to_json)
+register_json_adapter((QuerySet, types.GeneratorType), list)
@@ -1 +1,3 @@
-from models import turn_on_switch, turn_off_switch
+from models import (
+    turn_on_switch, turn_off_switch, set_switches, set_switch_group,
+    get_switch_states, switch_state_changed, start_discovery)
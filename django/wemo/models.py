@@ -1,28 +1,243 @@
+import time
+import threading
+import traceback
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
 import ouimeaux.environment
-import psutil
+import ouimeaux.device
+import ouimeaux.device.switch
+import ouimeaux.signals
+from django import db
+from django.db import models
+from django.conf import settings
+from django.dispatch import Signal
+
+class SwitchAddress(models.Model):
+    """The address where a switch was last found, so that a new process can
+    use the switch without waiting for discovery.
+    """
+    name = models.CharField(max_length=60, unique=True)
+    setup_url = models.CharField(max_length=200)
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        app_label = "wemo"
+
+#----------------------------------------------------------------------------
+# Discovery functions:
+
+# Switches are discovered by a background thread that owns the ouimeaux
+# environment.  It broadcasts for DISCOVERY_TIME_IN_S seconds at startup and
+# every WEMO_DISCOVERY_INTERVAL_IN_S seconds after that, and lets the
+# environment's servers run in between.
+DISCOVERY_TIME_IN_S = 5
+
+# WeMo devices listen on one of these ports, and may move between them when
+# they restart.
+SWITCH_PORTS = range(49152, 49156)
+
+_switches = {}
+_discovery_thread = None
+_discovery_event = threading.Event()
+_discovery_lock = threading.Lock()
+
+def start_discovery():
+    """Start discovering switches in the background, if that hasn't been
+    started already.
+    """
+    global _discovery_thread
+    with _discovery_lock:
+        if _discovery_thread is not None and _discovery_thread.is_alive():
+            return
 
-_cached_environment = None
-def _environment():
-    global _cached_environment
-    if _cached_environment is None:
-        _cached_environment = ouimeaux.environment.Environment()
-        _cached_environment.start()
-        _cached_environment.discover(1)
+        _discovery_thread = threading.Thread(
+            target=_run_discovery_thread, name="wemo-discovery")
+        _discovery_thread.daemon = True
+        _discovery_thread.start()
 
-    return _cached_environment
+def discover_soon():
+    """Wake the discovery thread up to search for switches again."""
+    _discovery_event.set()
 
-def _is_ouimeaux_server_running():
-    for connection in psutil.net_connections():
-        if connection.laddr[1] == 8989 and connection.status == "LISTEN":
-            return True
+def _run_discovery_thread():
+    environment = ouimeaux.environment.Environment(
+        switch_callback=_discovered_switch, with_cache=False)
+    environment.start()
 
-    return False
+    while True:
+        try:
+            environment.discover(DISCOVERY_TIME_IN_S)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            db.connection.close()
+
+        # Let the environment's servers run until it's time to search again.
+        end_time = time.time() + getattr(
+            settings, "WEMO_DISCOVERY_INTERVAL_IN_S", 300)
+        while not _discovery_event.is_set() and time.time() < end_time:
+            environment.wait(1)
+        _discovery_event.clear()
+
+def _discovered_switch(switch):
+    _found_switch(switch)
+    try:
+        _set_switch_state(switch.name, switch.get_state(force_update=True))
+    except Exception:
+        traceback.print_exc()
+
+def _found_switch(switch):
+    _switches[switch.name] = switch
+    setup_url = _setup_url(switch)
+    if SwitchAddress.objects.filter(
+            name=switch.name, setup_url=setup_url).exists():
+        return
+    SwitchAddress.objects.update_or_create(
+        name=switch.name, defaults={"setup_url": setup_url})
+
+def _setup_url(switch):
+    url_parts = urlparse.urlsplit(switch.basicevent.eventSubURL)
+    return "%s://%s/setup.xml" % (url_parts.scheme, url_parts.netloc)
+
+#----------------------------------------------------------------------------
+# Switch functions:
 
 def _switch(switch_name):
-    return _environment().get_switch(switch_name)
+    """Return the switch with the given name, from what discovery found or,
+    if it hasn't found it yet, from where it was last seen.
+    """
+    # The ouimeaux server runs in the discovery thread, so start it again if
+    # it has died.
+    start_discovery()
+
+    switch = _switches.get(switch_name)
+    if switch is not None:
+        return switch
+
+    switch_addresses = SwitchAddress.objects.filter(name=switch_name)
+    if len(switch_addresses) == 0:
+        discover_soon()
+        raise RuntimeError("Unknown switch: %s" % switch_name)
+
+    switch = ouimeaux.device.switch.Switch(switch_addresses[0].setup_url)
+    _switches[switch_name] = switch
+    return switch
+
+def _rediscover_switch(switch_name):
+    """Look for a switch that stopped answering at its last known address on
+    the other ports of the same host, falling back to a full discovery in the
+    background if it isn't there.
+    """
+    _switches.pop(switch_name, None)
+    switch_addresses = SwitchAddress.objects.filter(name=switch_name)
+    if len(switch_addresses) != 0:
+        host = urlparse.urlsplit(switch_addresses[0].setup_url).hostname
+        for port in SWITCH_PORTS:
+            try:
+                switch = ouimeaux.device.switch.Switch(
+                    "http://%s:%s/setup.xml" % (host, port))
+            except Exception:
+                continue
+            if switch.name == switch_name:
+                _found_switch(switch)
+                return switch
+
+    discover_soon()
+    raise RuntimeError("Could not reach switch: %s" % switch_name)
+
+def _call_switch(switch_name, function):
+    try:
+        return function(_switch(switch_name))
+    except (requests.exceptions.RequestException,
+            ouimeaux.device.DeviceUnreachable):
+        return function(_rediscover_switch(switch_name))
 
 def turn_on_switch(switch_name):
-    _switch(switch_name).on()
+    _call_switch(switch_name, lambda switch: switch.on())
+    _set_switch_state(switch_name, 1)
 
 def turn_off_switch(switch_name):
-    _switch(switch_name).off()
+    _call_switch(switch_name, lambda switch: switch.off())
+    _set_switch_state(switch_name, 0)
+
+#----------------------------------------------------------------------------
+# Switch state functions:
+
+# This maps switch names to whether they're on.  It's filled in when switches
+# are discovered, and kept up to date by the events the switches send to the
+# ouimeaux server and by our own changes, so reading it never has to ask the
+# switches.
+_switch_states = {}
+
+# This signal is sent when a switch is turned on or off.
+switch_state_changed = Signal(providing_args=["switch_name", "is_on"])
+
+def get_switch_states():
+    """Return a dictionary mapping the names of the known switches to True if
+    they are on and False if they are off.
+    """
+    start_discovery()
+    return dict(_switch_states)
+
+def _set_switch_state(switch_name, state):
+    is_on = (int(state) != 0)
+    if _switch_states.get(switch_name) == is_on:
+        return
+
+    _switch_states[switch_name] = is_on
+    switch_state_changed.send(
+        sender=None, switch_name=switch_name, is_on=is_on)
+
+@ouimeaux.signals.receiver(ouimeaux.signals.statechange)
+def _on_switch_state_change(sender, **kwargs):
+    _set_switch_state(sender.name, kwargs["state"])
+
+#----------------------------------------------------------------------------
+# Multiple switch functions:
+
+# Switching many switches at once uses up to this many threads.
+MAX_SWITCHING_THREADS = 8
+
+_cached_thread_pool = None
+def _thread_pool():
+    global _cached_thread_pool
+    if _cached_thread_pool is None:
+        _cached_thread_pool = ThreadPool(MAX_SWITCHING_THREADS)
+    return _cached_thread_pool
+
+def set_switches(switch_names, is_on):
+    """Turn the given switches on or off concurrently.  Returns a dictionary
+    mapping each switch name to a dictionary with the error, if any, and how
+    long the switch took.
+    """
+    return dict(_thread_pool().map(
+        lambda switch_name: (switch_name, _timed_set_switch(switch_name, is_on)),
+        switch_names))
+
+def set_switch_group(group_name, is_on):
+    """Like set_switches, for the switches in a group from the
+    WEMO_SWITCH_GROUPS setting.
+    """
+    switch_groups = getattr(settings, "WEMO_SWITCH_GROUPS", {})
+    if group_name not in switch_groups:
+        raise RuntimeError("Unknown switch group: %s" % group_name)
+    return set_switches(switch_groups[group_name], is_on)
+
+def _timed_set_switch(switch_name, is_on):
+    start_time = time.time()
+    error = None
+    try:
+        (turn_on_switch if is_on else turn_off_switch)(switch_name)
+    except Exception as e:
+        error = str(e)
+    finally:
+        db.connection.close()
+
+    return {
+        "error": error,
+        "duration_in_ms": int(round((time.time() - start_time) * 1000)),
+    }